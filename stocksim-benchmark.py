@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Simon Shink
+
+# This file is part of StockSim.
+#
+# StockSim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# StockSim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+from stocksim import *
+
+# Stages in pipeline order
+STAGES = ("load_history_csv", "load_history_json", "load_dividend", "load_transactions", "calc_shares", "calc_value",
+          "calc_cost", "calc_gain", "calc_gainp", "calc_data", "output")
+END = date(2016, 12, 30)
+
+
+def generate(years, seed, transaction_type=TransactionType.Cash):
+    # Deterministic synthetic stock: weekday OHLCV history up to END as a random walk, quarterly dividends and
+    # monthly purchases with a partial sale every year. Returns rows of (date, open, high, low, close, volume),
+    # (date, amount) and (date, cash or shares).
+    rng = random.Random(seed)
+    day = END - timedelta(int(years * 365.25))
+    close = rng.uniform(10, 100)
+    history = []
+    while day <= END:
+        if day.weekday() < 5:
+            price = close
+            close = round(max(0.01, price * (1 + rng.gauss(0.0003, 0.015))), 2)
+            high = round(max(price, close) * (1 + abs(rng.gauss(0, 0.005))), 2)
+            low = round(min(price, close) * (1 - abs(rng.gauss(0, 0.005))), 2)
+            history.append((day, price, high, low, close, rng.randint(1000, 100000)))
+        day += timedelta(1)
+
+    dividend = []
+    transactions = []
+    month = None
+    shares = 0
+    for i, (day, price, high, low, close, volume) in enumerate(history):
+        if (day.year, day.month) == month:
+            continue
+        # First trading day of a month
+        month = (day.year, day.month)
+        if day.month % 3 == 0 and i:
+            dividend.append((day, round(close * rng.uniform(0.002, 0.01), 3)))
+        if day.month == 12 and shares > 0:
+            amount = -int(shares * rng.uniform(0.1, 0.5))
+        else:
+            amount = rng.randint(1, 20)
+        if amount == 0:
+            continue
+        shares += amount
+        if transaction_type == TransactionType.Cash:
+            transactions.append((day, round(amount * close, 2)))
+        else:
+            transactions.append((day, amount))
+    return history, dividend, transactions
+
+
+def history_csv(history):
+    return "Date,Open,High,Low,Close,Volume\n" + "".join("{},{},{},{},{},{}\n".format(*row) for row in history)
+
+
+def history_json(history, symbol):
+    # QuoteMedia JSON, newest first
+    eoddata = [{"date": str(d), "unadjustedopen": o, "unadjustedhigh": h, "unadjustedlow": l, "unadjustedclose": c,
+                "sharevolume": v} for d, o, h, l, c, v in reversed(history)]
+    return json.dumps({"results": {"history": [{"symbol": symbol, "eoddata": eoddata}]}})
+
+
+def series_csv(header, rows):
+    return header + "\n" + "".join("{},{}\n".format(*row) for row in rows)
+
+
+def write_portfolio(directory, symbols, years, seed, transaction_type=TransactionType.Cash):
+    # The generated stocks as a portfolio directory for stocksim-portfolio.py
+    for i in range(symbols):
+        symbol = "S{:05d}".format(i)
+        history, dividend, transactions = generate(years, seed + i, transaction_type)
+        folder = os.path.join(directory, symbol)
+        os.makedirs(folder, exist_ok=True)
+        for name, text in (("history.txt", history_csv(history)),
+                           ("dividend.txt", series_csv("Date,Dividends", dividend)),
+                           ("transactions.csv", series_csv("Date,Amount", transactions))):
+            with open(os.path.join(folder, name), "w", newline="") as file:
+                file.write(text)
+
+
+def run(history, dividend, transactions, symbol, transaction_type=TransactionType.Cash, reinvest=True):
+    # Seconds and rows per stage for one stock
+    history_text = history_csv(history)
+    json_text = history_json(history, symbol)
+    dividend_text = series_csv("Date,Dividends", dividend)
+    transactions_text = series_csv("Date,Amount", transactions)
+    stock = Stock()
+    stock.reinvest = reinvest
+    stock.transactions.type = transaction_type
+
+    def load_history_json():
+        StockHistory().load(json_text, DataMode.JSON)
+
+    def load_dividend():
+        stock.history.init_dividend()
+        stock.history.dividend.load(dividend_text)
+
+    stages = (("load_history_csv", lambda: stock.history.load(history_text), lambda: len(stock.history)),
+              ("load_history_json", load_history_json, lambda: len(history)),
+              ("load_dividend", load_dividend, lambda: len(stock.history.dividend)),
+              ("load_transactions", lambda: stock.transactions.load(transactions_text),
+               lambda: len(stock.transactions)),
+              ("calc_shares", stock.calc_shares, lambda: len(stock.shares)),
+              ("calc_value", stock.calc_value, lambda: len(stock.value)),
+              ("calc_cost", stock.calc_cost, lambda: len(stock.cost)),
+              ("calc_gain", stock.calc_gain, lambda: len(stock.gain)),
+              ("calc_gainp", stock.calc_gainp, lambda: len(stock.gainp)),
+              ("calc_data", stock.calc_data, lambda: len(stock.data)),
+              ("output", lambda: stock.output(io.StringIO()), lambda: len(stock.data)))
+    results = {}
+    for name, stage, rows in stages:
+        start = time.perf_counter()
+        stage()
+        results[name] = (time.perf_counter() - start, rows())
+    return results
+
+
+def benchmark(years=10, symbols=1, seed=0, repeat=3, transaction_type=TransactionType.Cash, reinvest=True):
+    # Best of repeat runs per stock and stage, summed over the stocks
+    stages = OrderedDict((name, {"seconds": 0.0, "rows": 0}) for name in STAGES)
+    for i in range(symbols):
+        history, dividend, transactions = generate(years, seed + i, transaction_type)
+        runs = [run(history, dividend, transactions, "S{:05d}".format(i), transaction_type, reinvest)
+                for _ in range(repeat)]
+        for name in STAGES:
+            stages[name]["seconds"] += min(r[name][0] for r in runs)
+            stages[name]["rows"] += runs[0][name][1]
+    return OrderedDict((("config", OrderedDict((("years", years), ("symbols", symbols), ("seed", seed),
+                                                 ("repeat", repeat), ("type", transaction_type.name),
+                                                 ("reinvest", reinvest)))),
+                        ("python", platform.python_version()),
+                        ("platform", platform.platform()),
+                        ("total", sum(s["seconds"] for s in stages.values())),
+                        ("stages", stages)))
+
+
+def compare(results, baseline, threshold):
+    # Prints the time ratio per stage against baseline results, returns the stages slower than threshold
+    slower = []
+    for name, stage in results["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before or not before["seconds"]:
+            continue
+        ratio = stage["seconds"] / before["seconds"]
+        print("{:20s} {:10.4f}s {:10.4f}s {:6.2f}x".format(name, before["seconds"], stage["seconds"], ratio),
+              file=sys.stderr)
+        if ratio > threshold:
+            slower.append(name)
+    return slower
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the load, calc and output stages on synthetic data")
+    parser.add_argument('-y', '--years', type=float, default=10, help="Years of history per stock (default: 10)")
+    parser.add_argument('-s', '--symbols', type=int, default=1, help="Number of stocks (default: 1)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the generated data (default: 0)")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per stock, the best is kept (default: 3)")
+    parser.add_argument('--shares', action="store_true", help="Generate share transactions instead of cash.")
+    parser.add_argument('-n', '--no-reinvest', action="store_true", help="Do not reinvest dividends.")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against.")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="With --compare, fail if a stage takes longer by this factor (default: 1.25)")
+    parser.add_argument('--write', metavar="DIRECTORY",
+                        help="Write the generated stocks as a portfolio directory instead of benchmarking.")
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    transaction_type = TransactionType.Shares if args.shares else TransactionType.Cash
+
+    if args.write:
+        write_portfolio(args.write, args.symbols, args.years, args.seed, transaction_type)
+        return
+
+    results = benchmark(args.years, args.symbols, args.seed, args.repeat, transaction_type, not args.no_reinvest)
+
+    with open(args.output, 'w') if isinstance(args.output, str) else sys.stdout as out:
+        json.dump(results, out, indent=2)
+        print(file=out)
+
+    if args.compare:
+        with open(args.compare) as file:
+            slower = compare(results, json.load(file), args.threshold)
+        if slower:
+            print("Slower: " + ", ".join(slower), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Simon Shink
+
+# This file is part of StockSim.
+#
+# StockSim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# StockSim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import sys
+from stocksim import *
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query a running stocksim-server.py")
+    parser.add_argument("query", help="shares, value, cost, gain, gainp or data (SYMBOL DATE), portfolio (DATE), "
+                                      "snapshot (DATE...), symbols, or - to send JSON requests from stdin")
+    parser.add_argument("arguments", nargs='*')
+    parser.add_argument('-s', '--socket', help="Unix socket of the server instead of TCP.")
+    parser.add_argument('--host', default="127.0.0.1", help="TCP address of the server (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="TCP port of the server (default: 8765)")
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+    return args
+
+
+def requests(args):
+    if args.query == "-":
+        # One request per line, sent as one batch
+        return [json.loads(line) for line in sys.stdin if line.strip()]
+    if args.query == "snapshot":
+        return [{"query": "snapshot", "dates": args.arguments}]
+    if args.query == "portfolio":
+        return [{"query": "portfolio", "date": d} for d in args.arguments]
+    if args.query == "symbols":
+        return [{"query": "symbols"}]
+    # SYMBOL DATE...
+    symbol = args.arguments[0] if args.arguments else None
+    return [{"query": args.query, "symbol": symbol, "date": d} for d in args.arguments[1:]]
+
+
+def main():
+    args = parse_args()
+
+    responses = query_server(requests(args), args.socket, args.host, args.port)
+
+    with open(args.output, 'w') if isinstance(args.output, str) else sys.stdout as out:
+        for response in responses:
+            print(json.dumps(response), file=out)
+    if any("error" in response for response in responses):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -18,7 +18,8 @@
 # along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-from datetime import datetime
+from bisect import bisect_left
+from datetime import date, datetime
 import stocksim
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -31,9 +32,190 @@ class Slots(QObject):
         super(Slots, self).__init__()
 
 
+class SeriesModel(QAbstractListModel):
+    # A date keyed series (Stock.data, a history, transactions) as a list model for QML views. Rows are looked
+    # up only when a view asks for them. With points, the model is a decimated view for charts: every step-th
+    # row plus the last, at most about points rows.
+    def __init__(self, fields=("value",), points=0):
+        super(SeriesModel, self).__init__()
+        self.fields = tuple(fields)
+        self.points = points
+        self.series = {}
+        self.dates = []
+        self.step = 1
+
+    def roleNames(self):
+        return {Qt.UserRole + i: name.encode() for i, name in enumerate(("date",) + self.fields)}
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid() or not self.dates:
+            return 0
+        return (len(self.dates) + self.step - 2) // self.step + 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        d = self.dates[min(index.row() * self.step, len(self.dates) - 1)]
+        field = role - Qt.UserRole
+        if field == 0 or role == Qt.DisplayRole:
+            return d.isoformat()
+        if not 0 < field <= len(self.fields):
+            return None
+        row = self.series[d]
+        return row[field - 1] if isinstance(row, tuple) else row
+
+    @staticmethod
+    def _dates(series):
+        # A copy, the index of a DateSeries changes with it
+        return list(series.dates()) if isinstance(series, stocksim.DateSeries) else sorted(series)
+
+    def _step(self, n):
+        return max(1, -(-n // self.points)) if self.points else 1
+
+    def set_series(self, series):
+        self.beginResetModel()
+        self.series = series
+        self.dates = SeriesModel._dates(series)
+        self.step = self._step(len(self.dates))
+        self.endResetModel()
+
+    def update(self, series, since):
+        # The rows from since on changed, were added or were dropped (see Stock.append)
+        if series is not self.series:
+            self.set_series(series)
+            return
+        dates = SeriesModel._dates(series)
+        if self.step != 1 or self._step(len(dates)) != 1:
+            self.set_series(self.series)
+            return
+        old, new = len(self.dates), len(dates)
+        first = bisect_left(self.dates, since)
+        if new < old:
+            self.beginRemoveRows(QModelIndex(), new, old - 1)
+            self.dates = dates
+            self.endRemoveRows()
+        elif new > old:
+            self.beginInsertRows(QModelIndex(), old, new - 1)
+            self.dates = dates
+            self.endInsertRows()
+        else:
+            self.dates = dates
+        if first < min(old, new):
+            self.dataChanged.emit(self.index(first), self.index(min(old, new) - 1))
+
+    @pyqtSlot(int)
+    def decimate(self, points):
+        self.points = points
+        self.set_series(self.series)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class JobSignals(QObject):
+    progress = pyqtSignal(int, int, int)  # job, done, total
+    finished = pyqtSignal(int, object)  # job, result
+    failed = pyqtSignal(int, str)  # job, error
+
+
+class Job(QRunnable):
+    # Runs task(job) on a thread pool. The task reports its progress with job.progress(), which also stops it
+    # once the job is cancelled; the result comes back through the signals, on the Qt thread.
+    def __init__(self, id, key, task, done):
+        super(Job, self).__init__()
+        self.id = id
+        self.key = key
+        self.task = task
+        self.done = done
+        self.cancelled = False
+        self.signals = JobSignals()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def progress(self, done, total):
+        self.check()
+        self.signals.progress.emit(self.id, done, total)
+
+    def run(self):
+        try:
+            result = self.task(self)
+        except Cancelled:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.id, repr(e))
+            return
+        self.signals.finished.emit(self.id, result)
+
+
 class StockSimGui(QObject, stocksim.StockSim):
+    CALC_STAGES = ("shares", "value", "cost", "gain", "gainp", "data")
+
+    # Job key (e.g. "calc:0"), done and total steps
+    progress = pyqtSignal(str, int, int, arguments=["key", "done", "total"])
+    # Job key, after its result is in place
+    finished = pyqtSignal(str, arguments=["key"])
+    # Job key, error
+    failed = pyqtSignal(str, str, arguments=["key", "error"])
+
     def __init__(self):
         super(StockSimGui, self).__init__()
+        # Loads and calculations run on the pool, at most one job per key: a new one cancels the one before
+        self.pool = QThreadPool.globalInstance()
+        self.jobs = {}
+        self.job_id = 0
+        # Models of the first stock for the views, charts use the decimated one
+        self.history_model = SeriesModel(stocksim.StockHistory.HistoryData._fields)
+        self.transactions_model = SeriesModel()
+        self.data_model = SeriesModel(stocksim.Stock.StockData._fields)
+        self.chart_model = SeriesModel(stocksim.Stock.StockData._fields, points=500)
+
+    def submit(self, key, task, done):
+        # Runs task(job) on the pool and then done(result) on the Qt thread, unless the job was replaced by then
+        self.cancel(key)
+        self.job_id += 1
+        job = Job(self.job_id, key, task, done)
+        job.signals.progress.connect(self.job_progress)
+        job.signals.finished.connect(self.job_finished)
+        job.signals.failed.connect(self.job_failed)
+        self.jobs[key] = job
+        self.pool.start(job)
+
+    @pyqtSlot(str)
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            job.cancelled = True
+
+    def current_job(self, id):
+        # The job with id if it is still the current one for its key (results of replaced jobs are dropped)
+        for job in self.jobs.values():
+            if job.id == id:
+                return job
+        return None
+
+    @pyqtSlot(int, int, int)
+    def job_progress(self, id, done, total):
+        job = self.current_job(id)
+        if job is not None:
+            self.progress.emit(job.key, done, total)
+
+    @pyqtSlot(int, object)
+    def job_finished(self, id, result):
+        job = self.current_job(id)
+        if job is not None:
+            del self.jobs[job.key]
+            job.done(result)
+            self.finished.emit(job.key)
+
+    @pyqtSlot(int, str)
+    def job_failed(self, id, error):
+        job = self.current_job(id)
+        if job is not None:
+            del self.jobs[job.key]
+            self.failed.emit(job.key, error)
 
     @pyqtSlot()
     def open_history(self):
@@ -45,15 +227,27 @@ class StockSimGui(QObject, stocksim.StockSim):
     def open_history_file(self):
         self.fileDialog.accepted.disconnect(self.open_history_file)
         r = "History opened at " + repr(datetime.utcnow())
-        with open(self.fileDialog.property("fileUrl").toLocalFile()) as file:
-            data = file.read()
-            root.update_history(data)
+        path = self.fileDialog.property("fileUrl").toLocalFile()
+
+        def task(job):
+            with open(path, newline="") as file:
+                return self.parse_history(file)
+        self.submit("history:0", task, lambda history: self.set_history(0, history))
         return r
 
-    @pyqtSlot(str)
-    @pyqtSlot(str, int)
-    def load_history(self, data, i=0):
-        self.stocks[i].history.load(data)
+    @staticmethod
+    def parse_history(data):
+        history = stocksim.StockHistory()
+        history.load(data)
+        return history
+
+    def set_history(self, i, history):
+        # The loaded history replaces the one of stock i, a calculation from the old one is stale
+        history.dividend = self.stocks[i].history.dividend
+        self.stocks[i].history = history
+        self.cancel("calc:%d" % i)
+        if i == 0:
+            self.history_model.set_series(history)
         # print(repr(self.stocks[i].history))
 
     @pyqtSlot()
@@ -65,26 +259,117 @@ class StockSimGui(QObject, stocksim.StockSim):
     @pyqtSlot()
     def open_transactions_file(self):
         self.fileDialog.accepted.disconnect(self.open_transactions_file)
-        with open(self.fileDialog.property("fileUrl").toLocalFile()) as file:
-            data = file.read()
-            root.update_transactions(data)
+        path = self.fileDialog.property("fileUrl").toLocalFile()
 
-    @pyqtSlot(str)
-    @pyqtSlot(str, int)
-    def load_transactions(self, data, i=0):
-        self.stocks[i].transactions.load(data)
+        t = self.stocks[0].transactions.type
+
+        def task(job):
+            with open(path, newline="") as file:
+                return self.parse_transactions(file, t)
+        self.submit("transactions:0", task, lambda transactions: self.set_transactions(0, transactions))
+
+    @staticmethod
+    def parse_transactions(data, t):
+        transactions = stocksim.TransactionHistory(t)
+        transactions.load(data)
+        return transactions
+
+    def set_transactions(self, i, transactions):
+        self.stocks[i].transactions = transactions
+        self.cancel("calc:%d" % i)
+        if i == 0:
+            self.transactions_model.set_series(transactions)
+
+    @pyqtSlot()
+    @pyqtSlot(int)
+    def calc_stock(self, i=0, stages=CALC_STAGES):
+        # Calculates a copy of stock i on the pool and swaps it in when done, the stock stays usable meanwhile
+        stock = self.stocks[i]
+
+        def task(job):
+            work = StockSimGui.copy_inputs(stock)
+            for n, stage in enumerate(stages):
+                job.progress(n, len(stages))
+                getattr(work, "calc_" + stage)()
+            job.progress(len(stages), len(stages))
+            return work
+
+        self.submit("calc:%d" % i, task, lambda work: self.set_stock(i, work, "data" in stages))
 
     @pyqtSlot()
     @pyqtSlot(int)
     def calc_stock_shares(self, i=0):
         print("calc_shares")
-        self.stocks[i].calc_shares()
+        self.calc_stock(i, ("shares",))
 
     @pyqtSlot()
     @pyqtSlot(int)
     def calc_stock_value(self, i=0):
         print("calc_value")
-        self.stocks[i].calc_value()
+        self.calc_stock(i, ("shares", "value"))
+
+    @pyqtSlot()
+    def calc_all(self):
+        # Recalculates every stock and the portfolio on the pool, one step per stock
+        stocks = list(self.stocks)
+
+        def task(job):
+            works = []
+            for n, stock in enumerate(stocks):
+                job.progress(n, len(stocks) + 1)
+                work = StockSimGui.copy_inputs(stock)
+                work.calc()
+                works.append(work)
+            job.progress(len(stocks), len(stocks) + 1)
+            portfolio = stocksim.Portfolio()
+            for n, work in enumerate(works):
+                portfolio.add(n, work)
+            portfolio.calc()
+            return works, portfolio
+
+        def done(result):
+            works, self.portfolio = result
+            for i, work in enumerate(works):
+                self.set_stock(i, work)
+        for i in range(len(stocks)):
+            self.cancel("calc:%d" % i)
+        self.submit("portfolio", task, done)
+
+    def set_stock(self, i, stock, data=True):
+        self.stocks[i] = stock
+        if i == 0 and data:
+            self.data_model.set_series(stock.data)
+            self.chart_model.set_series(stock.data)
+
+    def append(self, i, history=None, dividend=None, transactions=None):
+        # Adds date keyed rows to stock i (see Stock.append), the views then only get the changed and new rows
+        self.cancel("calc:%d" % i)
+        stock = self.stocks[i]
+        stock.append(history, dividend, transactions)
+        if i == 0:
+            if history:
+                self.history_model.update(stock.history, min(history))
+            if transactions:
+                self.transactions_model.update(stock.transactions, min(transactions))
+            if history or dividend or transactions:
+                # Earlier days can change too (zero shares or cost reach forward), so every row is refreshed
+                self.data_model.update(stock.data, date.min)
+                self.chart_model.update(stock.data, date.min)
+
+    @staticmethod
+    def copy_inputs(stock):
+        # A new Stock sharing the inputs of stock, to calculate without touching its series
+        work = stocksim.Stock()
+        work.history = stock.history
+        work.transactions = stock.transactions
+        work.reinvest = stock.reinvest
+        work.columnar = stock.columnar
+        work.lazy = stock.lazy
+        work.currency = stock.currency
+        work.base = stock.base
+        work.fx = stock.fx
+        work.result_cache = stock.result_cache
+        return work
 
     history_opened = pyqtSignal()
 
@@ -128,7 +413,9 @@ ss = StockSimGui()
 if __name__ == '__main__':
     app = QGuiApplication(sys.argv)
     slots = Slots()
-    window = MainWindow([("testslots", slots), ("stocksim", ss)])
+    window = MainWindow([("testslots", slots), ("stocksim", ss), ("historyModel", ss.history_model),
+                         ("transactionsModel", ss.transactions_model), ("stockData", ss.data_model),
+                         ("chartData", ss.chart_model)])
     root = window.rootObject()
     FileDialog = QQmlComponent(window.engine(), "fileDialog.qml")
     ss.fileDialog = FileDialog.create()
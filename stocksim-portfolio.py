@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Simon Shink
+
+# This file is part of StockSim.
+#
+# StockSim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# StockSim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import sys
+from stocksim import *
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Calculate a portfolio of stocks in parallel")
+    parser.add_argument("manifest", help="Manifest CSV (symbol,history,transactions,dividend,mode) or a directory "
+                                         "with history.txt, transactions.csv and dividend.txt per symbol")
+    parser.add_argument('-p', '--processes', type=int, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('-n', '--no-reinvest', action="store_true", help="Do not reinvest dividends.")
+    parser.add_argument('--columnar', action="store_true", help="Use the columnar calculation (needs numpy).")
+    parser.add_argument('-c', '--cache', help="Directory for a binary cache of the parsed input files.")
+    parser.add_argument('--export', metavar="FILE", help="Also write the data of every stock as one wide table.")
+    parser.add_argument('-f', '--format', choices=["csv", "ndjson", "binary"], default="csv",
+                        help="Format of --export: CSV (default), newline-delimited JSON or binary columns.")
+    parser.add_argument('--period', choices=["day", "week", "month", "year"], default="day",
+                        help="Only output the last day of each week, month or year (default: every day).")
+    parser.add_argument('--as-of', nargs='+', metavar="DATE", type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+                        help="Write the shares, value, cost and gain of every stock as of each DATE (YYYY-MM-DD) "
+                             "instead of the portfolio series.")
+    parser.add_argument('--profile', nargs='?', const='-', metavar="FILE",
+                        help="Write a JSON profile of the stages per symbol to FILE (default: stderr).")
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    with Profiler() if args.profile else contextlib.nullcontext() as profiler:
+        period = None if args.period == "day" else Period[args.period.upper()]
+        portfolio = Portfolio()
+        portfolio.calc_entries(read_manifest(args.manifest), args.processes, not args.no_reinvest, args.columnar,
+                               args.cache)
+
+        with open(args.output, 'w', newline='') if isinstance(args.output, str) else sys.stdout as out:
+            if args.as_of:
+                Portfolio.write_snapshot(portfolio.snapshot(args.as_of), out)
+            else:
+                portfolio.output(out, period)
+
+        if args.export:
+            with open(args.export, 'wb') if args.format == "binary" else open(args.export, 'w', newline='') as out:
+                portfolio.export(out, ExportFormat[args.format.upper()], period)
+
+    if args.profile:
+        with open(args.profile, 'w') if args.profile != '-' else contextlib.nullcontext(sys.stderr) as out:
+            profiler.write(out)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Simon Shink
+
+# This file is part of StockSim.
+#
+# StockSim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# StockSim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import sys
+from stocksim import *
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Keep a portfolio of stocks calculated in memory and answer queries "
+                                                 "from stocksim-client.py")
+    parser.add_argument("manifest", help="Manifest CSV (symbol,history,transactions,dividend,mode) or a directory "
+                                         "with history.txt, transactions.csv and dividend.txt per symbol")
+    parser.add_argument('-s', '--socket', help="Listen on this Unix socket instead of TCP.")
+    parser.add_argument('--host', default="127.0.0.1", help="TCP address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="TCP port to listen on (default: 8765)")
+    parser.add_argument('-p', '--processes', type=int, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('-n', '--no-reinvest', action="store_true", help="Do not reinvest dividends.")
+    parser.add_argument('-c', '--cache', help="Directory for a binary cache of the parsed input files.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    server = StockServer()
+    server.load(read_manifest(args.manifest), args.processes, not args.no_reinvest, args.cache)
+    print("Loaded {} stocks, listening on {}".format(len(server.stocks), args.socket or
+                                                       "{}:{}".format(args.host, args.port)), file=sys.stderr)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -18,15 +18,47 @@
 # along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
 import json
-from collections import namedtuple, OrderedDict
+import math
+import mmap
+import multiprocessing.shared_memory
+import os
+import pickle
+import re
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import deque, namedtuple, OrderedDict
 from enum import Enum
 from datetime import date, datetime, timedelta
+from bisect import bisect_left, bisect_right, insort
+from heapq import heappop, heappush, merge
+from itertools import chain, count, islice
+from array import array
 import csv
+import gc
 import sys
 
-DataMode = Enum("Mode", "CSV JSON")
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DataMode = Enum("Mode", "CSV JSON", qualname="DataMode")
 TransactionType = Enum("TransactionType", "Cash Shares")
+ExportFormat = Enum("ExportFormat", "CSV NDJSON BINARY", qualname="ExportFormat")
+Period = Enum("Period", "WEEK MONTH YEAR", qualname="Period")
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
 
 def floatornone(s):
@@ -37,104 +69,821 @@ def intornone(s):
     return None if s is None else int(s)
 
 
-class StockHistory(dict):
+# Profiling: the stages decorated with profiled() report a ProfileRecord to every registered callback, with the
+# seconds, the rows processed and (while tracemalloc traces) the peak bytes allocated above the start.
+ProfileRecord = namedtuple("ProfileRecord", "symbol, stage, seconds, rows, peak")
+PROFILE_CALLBACKS = []
+
+
+class _ProfileState(threading.local):
+    # The symbol and the enclosing stages of each thread
+    def __init__(self):
+        super(_ProfileState, self).__init__()
+        self.symbols = [None]
+        self.stack = []
+
+
+_profile_state = _ProfileState()
+
+
+def add_profile_callback(callback):
+    PROFILE_CALLBACKS.append(callback)
+
+
+def remove_profile_callback(callback):
+    PROFILE_CALLBACKS.remove(callback)
+
+
+def report_profile(record):
+    for callback in PROFILE_CALLBACKS:
+        callback(record)
+
+
+@contextlib.contextmanager
+def profile_symbol(symbol):
+    # The stages run inside are reported for symbol
+    _profile_state.symbols.append(symbol)
+    try:
+        yield
+    finally:
+        _profile_state.symbols.pop()
+
+
+def _stage_rows(obj, result):
+    return len(obj if result is None else result)
+
+
+def profiled(stage, rows=_stage_rows):
+    # Decorator reporting each call of a method as stage, rows(self, result) gives the rows it processed. Without
+    # callbacks the method is called directly.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not PROFILE_CALLBACKS:
+                return method(self, *args, **kwargs)
+            memory = tracemalloc.is_tracing()
+            stack = _profile_state.stack
+            if memory:
+                current, peak = tracemalloc.get_traced_memory()
+                if stack:
+                    # Keep the peak of the enclosing stage up to here
+                    stack[-1][1] = max(stack[-1][1], peak)
+                tracemalloc.reset_peak()
+                stack.append([current, current])
+            start = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                if memory:
+                    base, peak = stack.pop()
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                    if stack:
+                        stack[-1][1] = max(stack[-1][1], peak)
+                    peak -= base
+            report_profile(ProfileRecord(_profile_state.symbols[-1], stage, seconds, rows(self, result),
+                                         peak if memory else None))
+            return result
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    # Profile callback collecting the records while it is entered. With memory it traces allocations for the
+    # peaks, which slows the stages down.
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.records = []
+        self._tracing = False
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        add_profile_callback(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_profile_callback(self)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    @staticmethod
+    def _add(totals, record):
+        totals["calls"] += 1
+        totals["seconds"] += record.seconds
+        totals["rows"] += record.rows
+        if record.peak is not None:
+            totals["peak"] = max(totals["peak"] or 0, record.peak)
+
+    def summary(self):
+        # Totals per stage and per symbol (slowest first), then the records
+        def totals():
+            return OrderedDict((("calls", 0), ("seconds", 0.0), ("rows", 0), ("peak", None)))
+        stages = OrderedDict()
+        symbols = OrderedDict()
+        for record in self.records:
+            Profiler._add(stages.setdefault(record.stage, totals()), record)
+            symbol = symbols.setdefault(record.symbol, OrderedDict((("symbol", record.symbol),
+                                                                    ("total", totals()),
+                                                                    ("stages", OrderedDict()))))
+            Profiler._add(symbol["total"], record)
+            Profiler._add(symbol["stages"].setdefault(record.stage, totals()), record)
+        return OrderedDict((("stages", stages),
+                            ("symbols", sorted(symbols.values(), key=lambda s: s["total"]["seconds"], reverse=True)),
+                            ("records", [record._asdict() for record in self.records])))
+
+    def write(self, output):
+        json.dump(self.summary(), output, indent=2)
+        print(file=output)
+
+
+def parse_date(s):
+    # YYYY-MM-DD, strptime is only used for irregular strings such as 2015-1-5
+    try:
+        return date.fromisoformat(s)
+    except ValueError:
+        return datetime.strptime(s, "%Y-%m-%d").date()
+
+
+def dated(loaded):
+    # Pairs of a dict keyed by date strings re-keyed by date, duplicates resolve in insertion order like the strings.
+    # fromisoformat is mapped over all keys at once, parse_date only runs when one of them is irregular.
+    try:
+        days = list(map(date.fromisoformat, loaded))
+    except ValueError:
+        days = list(map(parse_date, loaded))
+    return zip(days, loaded.values())
+
+
+class DateParser(dict):
+    # Memoizing parse_date for inputs that repeat dates (several JSON entries, server requests).
+    # CSV files have one row per date, so their loaders parse all dates at the end with dated().
+    def __missing__(self, s):
+        d = self[s] = parse_date(s)
+        return d
+
+
+@contextlib.contextmanager
+def gc_paused():
+    # Bulk loads only create acyclic rows that all survive, the collections they trigger would just rescan them
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def open_source(data):
+    # Loader input is the file contents, a path or an open text file
+    if isinstance(data, str):
+        return io.StringIO(data)
+    elif isinstance(data, os.PathLike):
+        return open(data, newline="")
+    else:
+        return contextlib.nullcontext(data)
+
+
+def read_csv(data, names=()):
+    # Yields the header positions of names (None if missing), then each non-empty row padded to the header width
+    # plus a trailing None that the missing columns point at.
+    # Plain lines are split directly, only lines with quotes go through the csv module.
+    with open_source(data) as file:
+        header = next(csv.reader(file), None)
+        if header is None:
+            return
+        header = [h.lower() for h in header]
+        width = len(header)
+        columns = {name: i for i, name in enumerate(header)}
+        yield [columns.get(name, width) for name in names]
+        fill = [None] * (width + 1)
+        for line in file:
+            row = line.rstrip("\r\n").split(",")
+            if len(row) == width and '"' not in line:
+                row.append(None)
+                yield row
+            elif '"' in line:
+                yield (next(csv.reader(chain([line], file))) + fill)[:width + 1]
+            elif line.strip():
+                yield (row + fill)[:width + 1]
+
+
+class JsonStream:
+    # Incremental reader of a JSON document: containers are walked key by key and element by element,
+    # and only the values asked for are decoded, so the whole tree is never held in memory
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+    # Used by skip(): the next bracket or quote, the rest of a string and the end of a number or literal
+    SPECIAL = re.compile(r'["\[\]{}]')
+    STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+    SCALAR_END = re.compile(r"[,\]}\s]")
+
+    def __init__(self, file, size=1 << 16):
+        self.file = file
+        self.size = size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        # Reads at least as much as is buffered, so a large value is not re-decoded once per chunk
+        chunk = self.file.read(max(self.size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _error(self, msg):
+        return json.JSONDecodeError(msg, self.buf, self.pos)
+
+    def peek(self):
+        while True:
+            self.pos = JsonStream.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise self._error("Unexpected end of data")
+
+    def take(self):
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number is only complete when a delimiter follows, it may continue in the next chunk
+                if self.eof or (end < len(self.buf) and (isinstance(value, bool) or
+                                                         not isinstance(value, (int, float)) or
+                                                         JsonStream.SCALAR_END.match(self.buf, end))):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def skip(self):
+        # Scans past the next value without decoding it
+        c = self.peek()
+        if c == '"':
+            self.pos += 1
+            self._skip_string()
+            return
+        if c not in "[{":
+            while True:
+                m = JsonStream.SCALAR_END.search(self.buf, self.pos)
+                if m is not None:
+                    self.pos = m.start()
+                    return
+                self.pos = len(self.buf)
+                if not self._fill():
+                    return
+        depth = 0
+        while True:
+            m = JsonStream.SPECIAL.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise self._error("Unexpected end of data")
+                continue
+            self.pos = m.end()
+            c = m.group()
+            if c == '"':
+                self._skip_string()
+            elif c in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skip_string(self):
+        # From after the opening quote to after the closing one
+        while True:
+            m = JsonStream.STRING_END.match(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.end()
+                return
+            if not self._fill():
+                raise self._error("Unterminated string")
+
+    def members(self):
+        # Yields the keys of an object, the caller consumes each value. Other values are skipped.
+        if self.peek() != "{":
+            self.skip()
+            return
+        self.pos += 1
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if self.take() != ":":
+                raise self._error("Expecting ':' delimiter")
+            yield key
+            c = self.take()
+            if c == "}":
+                return
+            if c != ",":
+                raise self._error("Expecting ',' delimiter")
+
+    def elements(self):
+        # Yields once per array element, the caller consumes each value. Other values are skipped.
+        if self.peek() != "[":
+            self.skip()
+            return
+        self.pos += 1
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        i = 0
+        while True:
+            yield i
+            i += 1
+            c = self.take()
+            if c == "]":
+                return
+            if c != ",":
+                raise self._error("Expecting ',' delimiter")
+
+
+# Members of a QuoteMedia entry kept in its info
+QUOTEMEDIA_INFO = ("symbol", "symbolstring")
+
+
+def iter_quotemedia(data, section, field):
+    # Yields (entry, info, record) for each record of results.<section>[entry].<field> as it is read.
+    # info holds the symbol members of the entry read so far, everything else is skipped without decoding.
+    with open_source(data) as file:
+        stream = JsonStream(file)
+        for key in stream.members():
+            if key != "results":
+                stream.skip()
+                continue
+            for key in stream.members():
+                if key != section:
+                    stream.skip()
+                    continue
+                for entry in stream.elements():
+                    info = {}
+                    for key in stream.members():
+                        if key != field:
+                            if key in QUOTEMEDIA_INFO:
+                                info[key] = stream.value()
+                            else:
+                                stream.skip()
+                            continue
+                        for _ in stream.elements():
+                            yield entry, info, stream.value()
+
+
+def quotemedia_symbol(info, entry):
+    return info.get("symbolstring") or info.get("symbol") or entry
+
+
+def history_symbol(path, mode=DataMode.CSV):
+    # The symbol of a history file: the QuoteMedia symbol of its first entry, else the file name without extension
+    # (the folder name for the <symbol>/history.txt layout of read_manifest)
+    if mode == DataMode.JSON:
+        with open(path, newline="") as file:
+            for entry, info, record in iter_quotemedia(file, "history", "eoddata"):
+                if quotemedia_symbol(info, None) is not None:
+                    return quotemedia_symbol(info, None)
+                break
+    folder, name = os.path.split(os.path.abspath(path))
+    if name == "history.txt":
+        return os.path.basename(folder)
+    return os.path.splitext(name)[0]
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("Columnar mode requires numpy")
+
+
+def next_period(d, period):
+    # First day of the period after the one of d (weeks start on Monday)
+    if period == Period.WEEK:
+        return d + timedelta(7 - d.weekday())
+    elif period == Period.MONTH:
+        return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+    return date(d.year + 1, 1, 1)
+
+
+def period_ends(dates, period):
+    # Positions of the last of the sorted dates in each period, found by bisecting for each period boundary
+    ends = []
+    n = len(dates)
+    i = 0
+    while i < n:
+        try:
+            i = bisect_left(dates, next_period(dates[i], period), i)
+        except OverflowError:
+            # Period of date.max
+            i = n
+        ends.append(i - 1)
+    return ends
+
+
+def to_days(dates):
+    # Sorted dates as int64 days since 1970-01-01 (datetime64[D] units)
+    return np.fromiter((d.toordinal() for d in dates), np.int64, len(dates)) - EPOCH_ORDINAL
+
+
+def from_days(days):
+    return np.asarray(days, dtype=np.int64).astype("datetime64[D]").tolist()
+
+
+def from_ordinals(days):
+    # Days since 1970-01-01 to dates, without numpy
+    fromordinal = date.fromordinal
+    return [fromordinal(d + EPOCH_ORDINAL) for d in days]
+
+
+class DateSeries(dict):
+    # Date keyed dict with a lazily built sorted key index for as-of lookups
+    _index = None
+
+    def _invalidate(self):
+        self._index = None
+
+    def __setitem__(self, key, value):
+        if self._index is not None and key not in self:
+            if not self._index or key > self._index[-1]:
+                self._index.append(key)
+            else:
+                insort(self._index, key)
+        super(DateSeries, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(DateSeries, self).__delitem__(key)
+        self._invalidate()
+
+    def pop(self, *args):
+        self._invalidate()
+        return super(DateSeries, self).pop(*args)
+
+    def popitem(self):
+        self._invalidate()
+        return super(DateSeries, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        self._invalidate()
+        super(DateSeries, self).update(*args, **kwargs)
+
+    def clear(self):
+        self._invalidate()
+        super(DateSeries, self).clear()
+
+    def dates(self):
+        if self._index is None:
+            self._index = sorted(self.keys())
+        return self._index
+
+    def get_latest(self, date: date):
+        if date in self:
+            return self[date]
+        index = self.dates()
+        i = bisect_right(index, date)
+        return self[index[i - 1]] if i > 0 else None
+
+    def get_next(self, date: date):
+        if date in self:
+            return self[date]
+        index = self.dates()
+        i = bisect_left(index, date)
+        return self[index[i]] if i < len(index) else None
+
+    def get_latest_many(self, dates):
+        # dates must be sorted; resolved in a single merge pass over the index from the first date on, or by
+        # bisecting from the previous position when there are far fewer dates than index entries
+        index = self.dates()
+        n = len(index)
+        result = []
+        if len(dates) * 16 < n:
+            i = 0
+            for d in dates:
+                if d in self:
+                    result.append(self[d])
+                    continue
+                i = bisect_right(index, d, i)
+                result.append(self[index[i - 1]] if i > 0 else None)
+            return result
+        i = bisect_right(index, dates[0]) if dates else 0
+        latest = index[i - 1] if i > 0 else None
+        for d in dates:
+            while i < n and index[i] <= d:
+                latest = index[i]
+                i += 1
+            result.append(None if latest is None else self[latest])
+        return result
+
+    def get_next_many(self, dates):
+        # dates must be sorted; resolved in a single merge pass over the index from the first date on
+        index = self.dates()
+        n = len(index)
+        result = []
+        i = bisect_left(index, dates[0]) if dates else 0
+        for d in dates:
+            while i < n and index[i] < d:
+                i += 1
+            result.append(self[index[i]] if i < n else None)
+        return result
+
+    def truncate(self, since):
+        # Drops the entries from since on, keeping the index
+        index = self.dates()
+        i = bisect_left(index, since)
+        for k in index[i:]:
+            dict.__delitem__(self, k)
+        del index[i:]
+
+    def extend(self, other):
+        # Adds the entries of other, keeping the index (appended when they come after the existing ones)
+        for k in (other.dates() if isinstance(other, DateSeries) else sorted(other)):
+            self[k] = other[k]
+
+    def resample(self, period):
+        # Last entry of each period, keyed by its date
+        index = self.dates()
+        return DateSeries((index[i], self[index[i]]) for i in period_ends(index, period))
+
+
+class InputSeries(DateSeries):
+    # Calculation input with a content fingerprint kept until it changes. HistoryCache presets it from the digest
+    # of the source file, so the series is not hashed again.
+    _fingerprint = None
+
+    def _invalidate(self):
+        super(InputSeries, self)._invalidate()
+        self._fingerprint = None
+
+    def __setitem__(self, key, value):
+        self._fingerprint = None
+        super(InputSeries, self).__setitem__(key, value)
+
+    def truncate(self, since):
+        self._fingerprint = None
+        super(InputSeries, self).truncate(since)
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint([(d, self[d]) for d in self.dates()])
+        return self._fingerprint
+
+
+class TradingCalendar:
+    # Sorted trading days of a history with their ordinals and positions. Histories with the same days share one
+    # calendar (see of()), so stocks of one exchange build it once.
+    _shared = weakref.WeakValueDictionary()
+
+    def __init__(self, dates):
+        self.dates = list(dates)
+        self.ordinals = array("q", [d.toordinal() for d in self.dates])
+        self.positions = {d: i for i, d in enumerate(self.dates)}
+        self._periods = {}
+
+    @classmethod
+    def of(cls, dates):
+        # The shared calendar of the sorted dates
+        ordinals = array("q", [d.toordinal() for d in dates])
+        key = hashlib.sha1(ordinals.tobytes()).digest()
+        calendar = cls._shared.get(key)
+        if calendar is None or calendar.ordinals != ordinals:
+            calendar = cls(dates)
+            cls._shared[key] = calendar
+        return calendar
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __reduce__(self):
+        return TradingCalendar.of, (self.dates,)
+
+    def before(self, date):
+        # Number of trading days before date
+        i = self.positions.get(date)
+        return bisect_left(self.dates, date) if i is None else i
+
+    def until(self, date):
+        # Number of trading days on or before date
+        i = self.positions.get(date)
+        return bisect_right(self.dates, date) if i is None else i + 1
+
+    def between(self, start, end):
+        # Trading days from start up to (not including) end
+        return self.dates[self.before(start):self.before(end)]
+
+    def period_ends(self, period):
+        # Positions of the last trading day of each period, computed once per period
+        ends = self._periods.get(period)
+        if ends is None:
+            ends = self._periods[period] = period_ends(self.dates, period)
+        return ends
+
+
+class StockHistory(InputSeries):
     HistoryData = namedtuple("HistoryData", "open, high, low, close, volume")
+    HistoryColumns = namedtuple("HistoryColumns", "date, open, high, low, close, volume")
+    # Nested so pickle can find them
+    HistoryData.__qualname__ = "StockHistory.HistoryData"
+    HistoryColumns.__qualname__ = "StockHistory.HistoryColumns"
+    _columns = None
+    _calendar = None
 
     def __init__(self):
         super(StockHistory, self).__init__()
         self.dividend = None
 
+    def _invalidate(self):
+        super(StockHistory, self)._invalidate()
+        self._columns = None
+        self._calendar = None
+
+    def __setitem__(self, key, value):
+        self._columns = None
+        if key not in self:
+            self._calendar = None
+        super(StockHistory, self).__setitem__(key, value)
+
+    def truncate(self, since):
+        self._columns = None
+        self._calendar = None
+        super(StockHistory, self).truncate(since)
+
+    def calendar(self):
+        if self._calendar is None:
+            self._calendar = TradingCalendar.of(self.dates())
+        return self._calendar
+
+    def columns(self):
+        # Columnar storage: datetime64[D] dates plus float64 OHLC and int64 volume, in date order.
+        # Missing prices are NaN and missing volume is 0.
+        if self._columns is None:
+            require_numpy()
+            dates = self.dates()
+            rows = [self[d] for d in dates]
+            self._columns = StockHistory.HistoryColumns(
+                to_days(dates).astype("datetime64[D]"),
+                np.array([r.open for r in rows], dtype=np.float64),
+                np.array([r.high for r in rows], dtype=np.float64),
+                np.array([r.low for r in rows], dtype=np.float64),
+                np.array([r.close for r in rows], dtype=np.float64),
+                np.array([r.volume or 0 for r in rows], dtype=np.int64))
+        return self._columns
+
+    def resample(self, period):
+        # OHLCV bars of each period keyed by its last trading day: the first open, highest high, lowest low, last
+        # close and total volume. Missing highs, lows and volumes are skipped.
+        bars = StockHistory()
+        dates = self.dates()
+        start = 0
+        for end in self.calendar().period_ends(period):
+            rows = [self[d] for d in dates[start:end + 1]]
+            highs = [r.high for r in rows if r.high is not None]
+            lows = [r.low for r in rows if r.low is not None]
+            volumes = [r.volume for r in rows if r.volume is not None]
+            bars[dates[end]] = StockHistory.HistoryData(rows[0].open, max(highs) if highs else None,
+                                                        min(lows) if lows else None, rows[-1].close,
+                                                        sum(volumes) if volumes else None)
+            start = end + 1
+        return bars
+
     def init_dividend(self):
         self.dividend = DividendHistory()
 
-    def load(self, data, mode=DataMode.CSV):
+    @profiled("load_history")
+    def load(self, data, mode=DataMode.CSV, entry=0):
         # print("Mode: " + mode.name)
+        # Bulk insert, sorted index is rebuilt on the next lookup
+        self._invalidate()
         if mode == DataMode.CSV:
-            lines = data.splitlines()
-            lines[0] = lines[0].lower()
-            r = csv.DictReader(lines)
             # date,open,high,low,close,volume
-            # self = dict()
-            for row in r:
-                d = datetime.strptime(list(row.values())[0], "%Y-%m-%d").date()
-                self[d] = StockHistory.HistoryData(floatornone(row.get("open")), floatornone(row.get("high")),
-                                                   floatornone(row.get("low")),
-                                                   floatornone(row.get("close")), intornone(row.get("volume")))
-                # print(d, self[d])
+            rows = read_csv(data, ("open", "high", "low", "close", "volume"))
+            o, h, l, c, v = next(rows, (0, 0, 0, 0, 0))
+            new = tuple.__new__
+            HistoryData = StockHistory.HistoryData
+            loaded = {}
+            with gc_paused():
+                for row in rows:
+                    try:
+                        loaded[row[0]] = new(HistoryData, (float(row[o]), float(row[h]), float(row[l]),
+                                                           float(row[c]), int(row[v])))
+                    except TypeError:
+                        # Short row or missing column
+                        loaded[row[0]] = new(HistoryData, (floatornone(row[o]), floatornone(row[h]),
+                                                           floatornone(row[l]), floatornone(row[c]),
+                                                           intornone(row[v])))
+            # The index was dropped above, so rows go straight into the dict
+            dict.update(self, dated(loaded))
         elif mode == DataMode.JSON:
-            # QuoteMedia JSON
-            jsondata = json.loads(data)
-            for eoddata in jsondata.get("results").get("history")[0].get("eoddata"):
-                d = datetime.strptime(eoddata.get("date"), "%Y-%m-%d").date()
-                self[d] = StockHistory.HistoryData(floatornone(eoddata.get("unadjustedopen")),
-                                                   floatornone(eoddata.get("unadjustedhigh")),
-                                                   floatornone(eoddata.get("unadjustedlow")),
-                                                   floatornone(eoddata.get("unadjustedclose")),
-                                                   intornone(eoddata.get("sharevolume")))
+            # QuoteMedia JSON, history entry number entry
+            parse = DateParser()
+            for i, info, eoddata in iter_quotemedia(data, "history", "eoddata"):
+                if i > entry:
+                    break
+                if i == entry:
+                    self[parse[eoddata.get("date")]] = StockHistory._from_eoddata(eoddata)
         else:
             # Unsupported mode
             pass
 
-    def get_latest(self, date: date):
-        if date in self:
-            return self[date]
-        elif date > min(self.keys()):
-            return self[max([d for d in self.keys() if d < date])]
-        else:
-            return None
+    @classmethod
+    def load_symbols(cls, data):
+        # QuoteMedia JSON with several history entries, by symbol (or entry number if the entry has none)
+        parse = DateParser()
+        histories = OrderedDict()
+        for i, info, eoddata in iter_quotemedia(data, "history", "eoddata"):
+            if i not in histories:
+                histories[i] = (info, cls())
+            histories[i][1][parse[eoddata.get("date")]] = StockHistory._from_eoddata(eoddata)
+        return OrderedDict((quotemedia_symbol(info, i), history) for i, (info, history) in histories.items())
 
-    def get_next(self, date: date):
-        if date in self:
-            return self[date]
-        elif date < max(self.keys()):
-            return self[min([d for d in self.keys() if d > date])]
-        else:
-            return None
+    @staticmethod
+    def _from_eoddata(eoddata):
+        return StockHistory.HistoryData(floatornone(eoddata.get("unadjustedopen")),
+                                        floatornone(eoddata.get("unadjustedhigh")),
+                                        floatornone(eoddata.get("unadjustedlow")),
+                                        floatornone(eoddata.get("unadjustedclose")),
+                                        intornone(eoddata.get("sharevolume")))
 
 
-class DividendHistory(dict):
+class DividendHistory(InputSeries):
     def __init__(self, t=TransactionType.Cash):
         super(DividendHistory, self).__init__()
         self.type = t
 
-    def load(self, data, mode=DataMode.CSV):
+    @profiled("load_dividend")
+    def load(self, data, mode=DataMode.CSV, entry=0):
+        self._invalidate()
         if mode == DataMode.CSV:
-            lines = data.splitlines()
-            lines[0] = lines[0].lower()
-            reader = csv.DictReader(lines)
-            for row in reader:
-                r = list(row.values())
-                d = datetime.strptime(r[0], "%Y-%m-%d").date()
-                v = float(r[1])
-                if v > 0:
-                    self[d] = v
+            rows = read_csv(data)
+            next(rows, None)
+            loaded = {}
+            with gc_paused():
+                for row in rows:
+                    v = float(row[1])
+                    if v > 0:
+                        loaded[row[0]] = v
+            dict.update(self, dated(loaded))
         elif mode == DataMode.JSON:
-            # QuoteMedia JSON
-            jsondata = json.loads(data)
-            for dividend in jsondata.get("results").get("dividends")[0].get("dividend"):
-                d = datetime.strptime(dividend.get("date"), "%Y-%m-%d").date()
-                self[d] = floatornone(dividend.get("amount"))
+            # QuoteMedia JSON, dividends entry number entry
+            parse = DateParser()
+            for i, info, dividend in iter_quotemedia(data, "dividends", "dividend"):
+                if i > entry:
+                    break
+                if i == entry:
+                    self[parse[dividend.get("date")]] = floatornone(dividend.get("amount"))
         else:
             # Unsupported mode
             pass
 
+    @classmethod
+    def load_symbols(cls, data, t=TransactionType.Cash):
+        # QuoteMedia JSON with several dividends entries, by symbol (or entry number if the entry has none)
+        parse = DateParser()
+        dividends = OrderedDict()
+        for i, info, dividend in iter_quotemedia(data, "dividends", "dividend"):
+            if i not in dividends:
+                dividends[i] = (info, cls(t))
+            dividends[i][1][parse[dividend.get("date")]] = floatornone(dividend.get("amount"))
+        return OrderedDict((quotemedia_symbol(info, i), dividend) for i, (info, dividend) in dividends.items())
 
-class TransactionHistory(dict):
+
+class TransactionHistory(InputSeries):
     def __init__(self, t=TransactionType.Cash):
         super(TransactionHistory, self).__init__()
         self.type = t
 
+    @profiled("load_transactions")
     def load(self, data, mode=DataMode.CSV):
+        self._invalidate()
         if mode == DataMode.CSV:
-            lines = data.splitlines()
-            lines[0] = lines[0].lower()
-            reader = csv.DictReader(lines)
-            for row in reader:
-                r = list(row.values())
-                d = datetime.strptime(r[0], "%Y-%m-%d").date()
-                v = float(r[1])
-                if v != 0:
-                    self[d] = v
+            rows = read_csv(data)
+            next(rows, None)
+            loaded = {}
+            with gc_paused():
+                for row in rows:
+                    v = float(row[1])
+                    if v != 0:
+                        loaded[row[0]] = v
+            dict.update(self, dated(loaded))
         elif mode == DataMode.JSON:
             # Not implemented
             pass
@@ -143,194 +892,896 @@ class TransactionHistory(dict):
             pass
 
 
+class HistoryCache:
+    # Binary cache of a parsed input file: a header followed by native int64 day and float64/int64 value columns.
+    # A cache file is stale when the source size changes, or its mtime changes and its content hash does too.
+    HEADER = struct.Struct("=8s8sqqq32s")  # magic, kind, rows, source size, source mtime_ns, source sha256
+    MAGIC = b"StockSim"
+    MISSING = -1  # Stored volume of rows without one
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, source, mode):
+        key = "{}:{}".format(os.path.abspath(source), mode.name).encode()
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + ".bin")
+
+    @staticmethod
+    def _kind(series):
+        return (b"H" if isinstance(series, StockHistory) else b"S") + sys.byteorder[0].encode()
+
+    @staticmethod
+    def size(kind, rows):
+        # Bytes of a cache file of kind with rows rows: the header, the day column and the value columns
+        return HistoryCache.HEADER.size + rows * 8 * (6 if kind.startswith(b"H") else 2)
+
+    @staticmethod
+    def digest(source):
+        h = hashlib.sha256()
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                h.update(chunk)
+        return h.digest()
+
+    def open(self, source, mode, series):
+        # Returns the mapped cache file of source, or None if there is no valid one
+        path = self.path(source, mode)
+        try:
+            file = open(path, "r+b")
+        except OSError:
+            return None
+        with file:
+            header = file.read(HistoryCache.HEADER.size)
+            if len(header) < HistoryCache.HEADER.size:
+                return None
+            magic, kind, rows, size, mtime, digest = HistoryCache.HEADER.unpack(header)
+            stat = os.stat(source)
+            if magic != HistoryCache.MAGIC or kind.rstrip(b"\0") != HistoryCache._kind(series) or size != stat.st_size:
+                return None
+            if os.fstat(file.fileno()).st_size != HistoryCache.size(kind, rows):
+                # Truncated or extended since it was written, rebuilt like a stale one
+                return None
+            if mtime != stat.st_mtime_ns:
+                if digest != HistoryCache.digest(source):
+                    return None
+                # Touched but unchanged
+                file.seek(0)
+                file.write(HistoryCache.HEADER.pack(magic, kind, rows, size, stat.st_mtime_ns, digest))
+                file.flush()
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def arrays(series):
+        # The day column followed by the value columns of series
+        dates = series.dates()
+        if isinstance(series, StockHistory):
+            rows = [series[d] for d in dates]
+            nan = float("nan")
+            columns = [array("d", [nan if r.open is None else r.open for r in rows]),
+                       array("d", [nan if r.high is None else r.high for r in rows]),
+                       array("d", [nan if r.low is None else r.low for r in rows]),
+                       array("d", [nan if r.close is None else r.close for r in rows]),
+                       array("q", [HistoryCache.MISSING if r.volume is None else r.volume for r in rows])]
+        else:
+            columns = [array("d", [series[d] for d in dates])]
+        return [array("q", [d.toordinal() - EPOCH_ORDINAL for d in dates])] + columns
+
+    def write(self, source, mode, series, stat, digest):
+        arrays = HistoryCache.arrays(series)
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(source, mode)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "wb") as file:
+            file.write(HistoryCache.HEADER.pack(HistoryCache.MAGIC, HistoryCache._kind(series), len(arrays[0]),
+                                                stat.st_size, stat.st_mtime_ns, digest))
+            for column in arrays:
+                column.tofile(file)
+        os.replace(temp, path)
+        return path
+
+    @profiled("load_cache")
+    def load(self, source, mode, series):
+        # Loads source into series through the cache. Histories come back as a MappedHistory reading the cache
+        # file directly, dividends and transactions are small and are filled from the mapped columns. A series
+        # loaded empty is fingerprinted by the digest of the source instead of its content.
+        stat = os.stat(source)
+        empty = not len(series)
+        mapped = self.open(source, mode, series)
+        if mapped is None:
+            with open(source, newline="") as file:
+                series.load(file, mode)
+            digest = HistoryCache.digest(source)
+            self.write(source, mode, series, stat, digest)
+        else:
+            magic, kind, rows, size, mtime, digest = HistoryCache.HEADER.unpack_from(mapped)
+            if isinstance(series, StockHistory):
+                series = MappedHistory(mapped, self.path(source, mode))
+                empty = True
+            else:
+                view = memoryview(mapped)
+                days, values = HistoryCache.columns(view, rows, "qd")
+                series._invalidate()
+                dict.update(series, zip(from_ordinals(days), values))
+                days.release()
+                values.release()
+                view.release()
+                mapped.close()
+        if empty:
+            series._fingerprint = fingerprint("source", HistoryCache._kind(series), mode.name, digest)
+        return series
+
+    @staticmethod
+    def columns(view, rows, formats):
+        offset = HistoryCache.HEADER.size
+        columns = []
+        for f in formats:
+            columns.append(view[offset:offset + rows * 8].cast(f))
+            offset += rows * 8
+        return columns
+
+
+class MappedHistory(StockHistory):
+    # StockHistory served from a memory-mapped cache file. Lookups bisect the mapped day column and only build
+    # the rows they return; the first change copies all rows into the dict and drops the mapping.
+    _map = None
+
+    def __init__(self, mapped, path):
+        super(MappedHistory, self).__init__()
+        self.path = path
+        self._map = mapped
+        self._rows = HistoryCache.HEADER.unpack_from(mapped)[2]
+        self._days, self._open, self._high, self._low, self._close, self._volume = \
+            HistoryCache.columns(memoryview(mapped), self._rows, "qddddq")
+
+    def __reduce_ex__(self, protocol):
+        if self._map is None:
+            return super(MappedHistory, self).__reduce_ex__(protocol)
+        # Workers reopen the cache file instead of receiving the rows
+        return open_mapped_history, (self.path,), {"dividend": self.dividend, "_fingerprint": self._fingerprint}
+
+    def _row(self, i):
+        def price(column):
+            v = column[i]
+            return None if v != v else v
+        volume = self._volume[i]
+        return StockHistory.HistoryData(price(self._open), price(self._high), price(self._low), price(self._close),
+                                        None if volume == HistoryCache.MISSING else volume)
+
+    def _find(self, key):
+        if not isinstance(key, date):
+            return -1
+        day = key.toordinal() - EPOCH_ORDINAL
+        i = bisect_left(self._days, day)
+        return i if i < self._rows and self._days[i] == day else -1
+
+    def _materialize(self):
+        if self._map is not None:
+            rows = [self._row(i) for i in range(self._rows)]
+            dates = self.dates()
+            self._days = self._open = self._high = self._low = self._close = self._volume = None
+            self._map = None
+            dict.update(self, zip(dates, rows))
+
+    def __getitem__(self, key):
+        if self._map is None:
+            return super(MappedHistory, self).__getitem__(key)
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._row(i)
+
+    def __contains__(self, key):
+        if self._map is None:
+            return super(MappedHistory, self).__contains__(key)
+        return self._find(key) >= 0
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __len__(self):
+        return super(MappedHistory, self).__len__() if self._map is None else self._rows
+
+    def __iter__(self):
+        return super(MappedHistory, self).__iter__() if self._map is None else iter(self.dates())
+
+    def keys(self):
+        return super(MappedHistory, self).keys() if self._map is None else self.dates()
+
+    def values(self):
+        return super(MappedHistory, self).values() if self._map is None else map(self._row, range(self._rows))
+
+    def items(self):
+        return super(MappedHistory, self).items() if self._map is None else zip(self.dates(), self.values())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return super(MappedHistory, self).__repr__() if self._map is None else \
+            "MappedHistory({!r}, {} rows)".format(self.path, self._rows)
+
+    def dates(self):
+        if self._map is not None and self._index is None:
+            self._index = from_ordinals(self._days)
+        return super(MappedHistory, self).dates()
+
+    def get_latest(self, date: date):
+        if self._map is None:
+            return super(MappedHistory, self).get_latest(date)
+        i = bisect_right(self._days, date.toordinal() - EPOCH_ORDINAL)
+        return self._row(i - 1) if i > 0 else None
+
+    def get_next(self, date: date):
+        if self._map is None:
+            return super(MappedHistory, self).get_next(date)
+        i = bisect_left(self._days, date.toordinal() - EPOCH_ORDINAL)
+        return self._row(i) if i < self._rows else None
+
+    def columns(self):
+        if self._map is None:
+            return super(MappedHistory, self).columns()
+        if self._columns is None:
+            require_numpy()
+            offset = HistoryCache.HEADER.size
+            n = self._rows
+
+            def column(i, dtype):
+                return np.frombuffer(self._map, dtype=dtype, count=n, offset=offset + i * n * 8)
+            volume = column(5, np.int64)
+            if (volume == HistoryCache.MISSING).any():
+                volume = np.where(volume == HistoryCache.MISSING, 0, volume)
+            self._columns = StockHistory.HistoryColumns(column(0, np.int64).view("datetime64[D]"),
+                                                        column(1, np.float64), column(2, np.float64),
+                                                        column(3, np.float64), column(4, np.float64), volume)
+        return self._columns
+
+    def __setitem__(self, key, value):
+        self._materialize()
+        super(MappedHistory, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._materialize()
+        super(MappedHistory, self).__delitem__(key)
+
+    def pop(self, *args):
+        self._materialize()
+        return super(MappedHistory, self).pop(*args)
+
+    def popitem(self):
+        self._materialize()
+        return super(MappedHistory, self).popitem()
+
+    def update(self, *args, **kwargs):
+        self._materialize()
+        super(MappedHistory, self).update(*args, **kwargs)
+
+    def clear(self):
+        self._materialize()
+        super(MappedHistory, self).clear()
+
+    def truncate(self, since):
+        self._materialize()
+        super(MappedHistory, self).truncate(since)
+
+    def load(self, data, mode=DataMode.CSV, entry=0):
+        self._materialize()
+        super(MappedHistory, self).load(data, mode, entry)
+
+
+class SharedSegment(multiprocessing.shared_memory.SharedMemory):
+    # Shared memory that stays mapped while histories still view it, instead of failing to close
+    def close(self):
+        try:
+            super(SharedSegment, self).close()
+        except BufferError:
+            pass
+
+
+class SharedHistory(MappedHistory):
+    # MappedHistory over a read-only view of a PriceStore segment. Pickles as the segment name, so process pool
+    # workers attach to the segment instead of receiving the rows.
+    def __init__(self, segment):
+        self.segment = segment
+        super(SharedHistory, self).__init__(segment.buf.toreadonly(), segment.name)
+
+    def __reduce_ex__(self, protocol):
+        if self._map is None:
+            return super(SharedHistory, self).__reduce_ex__(protocol)
+        return attach_shared_history, (self.path,), {"dividend": self.dividend, "_fingerprint": self._fingerprint}
+
+    def __repr__(self):
+        return super(SharedHistory, self).__repr__() if self._map is None else \
+            "SharedHistory({!r}, {} rows)".format(self.path, self._rows)
+
+
+# Segments attached by this process, by name
+_shared_segments = {}
+
+
+def attach_shared_history(name):
+    # Each process attaches a segment once, its histories share the mapping
+    segment = _shared_segments.get(name)
+    if segment is None:
+        segment = _shared_segments[name] = SharedSegment(name)
+    return SharedHistory(segment)
+
+
+class PriceStore:
+    # Owns stock histories copied into shared memory segments in the HistoryCache layout, see SharedHistory.
+    # Identical histories share one segment. put() and acquire() take a reference to a segment and release()
+    # drops one, the last reference unlinks it; close() (or leaving the with block) unlinks every segment. The
+    # multiprocessing resource tracker unlinks the segments of an owner that crashed.
+    def __init__(self):
+        super(PriceStore, self).__init__()
+        # name: [segment, references]
+        self.segments = OrderedDict()
+        self._names = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, history: StockHistory):
+        # A SharedHistory with the rows and dividends of history
+        key = history.fingerprint()
+        name = self._names.get(key)
+        if name is None:
+            arrays = HistoryCache.arrays(history)
+            rows = len(arrays[0])
+            segment = SharedSegment(create=True, size=HistoryCache.HEADER.size + rows * 8 * len(arrays))
+            HistoryCache.HEADER.pack_into(segment.buf, 0, HistoryCache.MAGIC, HistoryCache._kind(history), rows,
+                                          0, 0, b"")
+            offset = HistoryCache.HEADER.size
+            for column in arrays:
+                segment.buf[offset:offset + rows * 8] = column.tobytes()
+                offset += rows * 8
+            name = self._names[key] = segment.name
+            self.segments[name] = [segment, 0]
+        self.segments[name][1] += 1
+        shared = SharedHistory(self.segments[name][0])
+        shared.dividend = history.dividend
+        shared._fingerprint = key
+        return shared
+
+    def acquire(self, history: SharedHistory):
+        self.segments[history.path][1] += 1
+
+    def release(self, history: SharedHistory):
+        entry = self.segments[history.path]
+        entry[1] -= 1
+        if entry[1] <= 0:
+            self._unlink(history.path)
+
+    def close(self):
+        for name in list(self.segments):
+            self._unlink(name)
+
+    def _unlink(self, name):
+        segment = self.segments.pop(name)[0]
+        self._names = {k: v for k, v in self._names.items() if v != name}
+        segment.unlink()
+        segment.close()
+
+
+def open_mapped_history(path):
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < HistoryCache.HEADER.size or \
+            len(mapped) != HistoryCache.size(*HistoryCache.HEADER.unpack_from(mapped)[1:3]):
+        mapped.close()
+        raise ValueError("Truncated history cache file: {}".format(path))
+    return MappedHistory(mapped, path)
+
+
+class RateIndex:
+    # Sorted dates and rates of one currency pair (the close of its history) for as-of joins. Missing closes are
+    # skipped.
+    def __init__(self, history: StockHistory, invert=False):
+        self.dates = []
+        self.rates = []
+        for d in history.dates():
+            rate = history[d].close
+            if rate:
+                self.dates.append(d)
+                self.rates.append(1 / rate if invert else rate)
+        self._columns = None
+
+    def __len__(self):
+        return len(self.dates)
+
+    def join(self, dates):
+        # Rate as of each of the sorted dates, in a single merge pass
+        result = []
+        n = len(self.dates)
+        i = bisect_right(self.dates, dates[0]) if dates else 0
+        for d in dates:
+            while i < n and self.dates[i] <= d:
+                i += 1
+            if i == 0:
+                raise ValueError("No exchange rate on or before {}".format(d))
+            result.append(self.rates[i - 1])
+        return result
+
+    def columns(self):
+        # int64 days since 1970-01-01 and float64 rates
+        if self._columns is None:
+            require_numpy()
+            self._columns = (to_days(self.dates), np.array(self.rates, dtype=np.float64))
+        return self._columns
+
+    def join_columns(self, days):
+        # join() of int64 days
+        h, rates = self.columns()
+        i = np.searchsorted(h, days, side="right") - 1
+        if len(i) and i.min() < 0:
+            raise ValueError("No exchange rate on or before {}".format(from_days(days[i < 0][:1])[0]))
+        return rates[i]
+
+
+class FxRates:
+    # Exchange rate histories by currency pair, loaded like stock histories with the close as the rate (units of
+    # the target currency per unit of the source currency). The RateIndex of a pair is built on first use and
+    # shared by every stock in that currency; the reverse pair is derived from it if it was not loaded.
+    def __init__(self):
+        super(FxRates, self).__init__()
+        self.histories = {}
+        self._indexes = {}
+        # token: set while process pool workers have these rates installed (see install_fx_rates), they are then
+        # pickled as the token only
+        self.token = None
+
+    def __reduce_ex__(self, protocol):
+        if self.token is not None:
+            return shared_fx_rates, (self.token,)
+        return super(FxRates, self).__reduce_ex__(protocol)
+
+    def load(self, source, target, data, mode=DataMode.CSV, entry=0):
+        history = StockHistory()
+        history.load(data, mode, entry)
+        self.add(source, target, history)
+        return history
+
+    def add(self, source, target, history: StockHistory):
+        self.histories[(source, target)] = history
+        self._indexes.clear()
+
+    def index(self, source, target):
+        # RateIndex converting source to target amounts
+        pair = (source, target)
+        history, invert = self.histories.get(pair), False
+        if history is None:
+            history, invert = self.histories.get((target, source)), True
+        if history is None:
+            raise KeyError("No exchange rates for {}/{}".format(source, target))
+        cached = self._indexes.get(pair)
+        if cached is None or cached[0] is not history or cached[1] != history.fingerprint():
+            cached = (history, history.fingerprint(), RateIndex(history, invert))
+            self._indexes[pair] = cached
+        return cached[2]
+
+    def fingerprint(self, source, target):
+        # Input key of a pair for the result cache
+        history = self.histories.get((source, target))
+        if history is not None:
+            return source, target, history.fingerprint()
+        return target, source, self.histories[(target, source)].fingerprint(), "inverse"
+
+
+# Rates installed in this process by token
+_installed_fx_rates = {}
+
+
+def install_fx_rates(token, histories, indexes):
+    # Process pool initializer: the rate histories and indexes of an FxRates, shared by the stocks sent later
+    fx = FxRates()
+    fx.histories = histories
+    fx._indexes = indexes
+    _installed_fx_rates[token] = fx
+
+
+def shared_fx_rates(token):
+    return _installed_fx_rates[token]
+
+
+def fingerprint(*parts):
+    # Content hash of the parts, date keyed series by their items in date order (and their type), input series by
+    # their own fingerprint
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, InputSeries):
+            part = (getattr(part, "type", None), part.fingerprint())
+        elif isinstance(part, dict):
+            series = Stock._as_series(part)
+            part = (getattr(part, "type", None), [(d, series[d]) for d in series.dates()])
+        h.update(pickle.dumps(part, 4))
+    return h.hexdigest()
+
+
+class ResultCache:
+    # Derived series by a fingerprint of their inputs, pickled in memory (least recently used dropped beyond size
+    # entries) and, with a directory, also on disk. Counts hits and misses per series.
+    # The files are unpickled as they are, which runs whatever code they name: the directory must only be
+    # writable by trusted users. It is created private to the current user.
+    def __init__(self, directory=None, size=64):
+        self.directory = directory
+        self.size = size
+        self.memory = OrderedDict()
+        self.stats = OrderedDict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+        elif self.directory is not None:
+            try:
+                with open(self.path(key), "rb") as file:
+                    data = file.read()
+            except OSError:
+                return None
+            self._remember(key, data)
+        return None if data is None else pickle.loads(data)
+
+    def put(self, key, series):
+        data = pickle.dumps(series, pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        if self.directory is not None:
+            os.makedirs(self.directory, 0o700, exist_ok=True)
+            path = self.path(key)
+            temp = "{}.{}.tmp".format(path, os.getpid())
+            with open(temp, "wb") as file:
+                file.write(data)
+            os.replace(temp, path)
+
+    def _remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def memoize(self, name, calc, *inputs):
+        # (key, series): the series calc() returned before for the same inputs, else calc() stored under key
+        key = fingerprint(name, *inputs)
+        stats = self.stats.setdefault(name, OrderedDict((("hits", 0), ("misses", 0))))
+        series = self.get(key)
+        if series is None:
+            stats["misses"] += 1
+            series = calc()
+            self.put(key, series)
+        else:
+            stats["hits"] += 1
+        return key, series
+
+    def totals(self):
+        return tuple(sum(s[k] for s in self.stats.values()) for k in ("hits", "misses"))
+
+
+class LazySeries:
+    # Derived series of a Stock. None marks it as pending (calc() in lazy mode), it is then calculated by the
+    # stock's calc_<name>() on first access and kept.
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.attr = "_" + name
+
+    def __get__(self, stock, owner=None):
+        if stock is None:
+            return self
+        if stock.__dict__.get(self.attr) is None:
+            getattr(stock, "calc_" + self.name)()
+        return stock.__dict__[self.attr]
+
+    def __set__(self, stock, value):
+        stock.__dict__[self.attr] = value
+
+
 class Stock:
     StockData = namedtuple("StockData", "shares, value, cost, gain, gainp")
+    SeriesColumns = namedtuple("SeriesColumns", "date, value")
+    StockData.__qualname__ = "Stock.StockData"
+    SeriesColumns.__qualname__ = "Stock.SeriesColumns"
+
+    shares = LazySeries()
+    cost = LazySeries()
+    value = LazySeries()
+    gain = LazySeries()
+    gainp = LazySeries()
+    data = LazySeries()
 
     def __init__(self):
         super(Stock, self).__init__()
         self.history = StockHistory()
         self.reinvest = False
+        self.columnar = False
+        # lazy: calc() only marks the series pending, each is calculated on first access and the get_* point
+        # queries are answered from the shares and cost changes and the history without the daily series
+        self.lazy = False
+        self._divisor = None
+        # result_cache: a ResultCache, the calc_* methods then reuse series calculated before from the same inputs
+        self.result_cache = None
+        self._result_keys = {}
+        # version: bumped by calc() and append(), which change the series in place
+        self.version = 0
+        # currency: of the prices and transactions, converted to the base currency with the rates of fx (FxRates)
+        # when both are set and differ. None means the base currency.
+        self.currency = None
+        self.base = None
+        self.fx = None
         self.transactions = TransactionHistory()
-        self.shares = {date.min: 0}
-        self.cost = {date.min: 0}
-        self.value = {date.min: 0}
-        self.gain = {date.min: 0}
-        self.gainp = {date.min: 0}
+        self.shares = DateSeries({date.min: 0})
+        self.cost = DateSeries({date.min: 0})
+        self.value = DateSeries({date.min: 0})
+        self.gain = DateSeries({date.min: 0})
+        self.gainp = DateSeries({date.min: 0})
         self.data = {date.min: 0}
-
-    def load_files(self, history, transactions, dividend=None, mode=DataMode.CSV):
-        with open(history) as file:
-            self.history.load(file.read(), mode)
-        with open(transactions) as file:
-            self.transactions.load(file.read(), mode)
-        with open(dividend) as file:
+        self.columns = None
+
+    def load_files(self, history, transactions, dividend=None, mode=DataMode.CSV, cache=None):
+        # cache: directory of the binary cache of parsed files, reused while the files are unchanged
+        # There is no JSON transaction format, mode only applies to history and dividend data
+        if cache is not None:
+            cache = HistoryCache(cache)
+            self.history = cache.load(history, mode, self.history)
+            cache.load(transactions, DataMode.CSV, self.transactions)
+            if dividend is not None:
+                self.history.init_dividend()
+                cache.load(dividend, mode, self.history.dividend)
+            return
+        with open(history, newline="") as h, open(transactions, newline="") as t, \
+                open(dividend, newline="") if dividend is not None else contextlib.nullcontext() as d:
+            self.load(h, t, d, mode)
+
+    def load(self, history, transactions, dividend=None, mode=DataMode.CSV):
+        # Inputs are file contents or open files, mode only applies to history and dividend data
+        self.history.load(history, mode)
+        self.transactions.load(transactions, DataMode.CSV)
+        if dividend is not None:
             self.history.init_dividend()
-            self.history.dividend.load(file.read(), mode)
+            self.history.dividend.load(dividend, mode)
 
+    @profiled("calc_shares")
     def calc_shares(self):
-        self.shares = self._calc_shares(self.transactions, self.history, self.reinvest)
+        dividend = self.history.dividend if self.reinvest else None
+        self.shares = self._memoize("shares", lambda: self._calc_shares(self.transactions, self.history, self.reinvest),
+                                    self.transactions, self.history.fingerprint(), self.reinvest, dividend)
         return self.shares
 
     @staticmethod
-    def _calc_shares(transactions: TransactionHistory, history: StockHistory = None, reinvest=False):
-        shares = {}
-        s = 0
-        if reinvest and history.dividend is not None:
-            div_dates = sorted(history.dividend)
-            # Find first applicable dividend date (shares > 0)
-            i = 0
-            while div_dates[i] < min(transactions):
-                i += 1
+    def _calc_shares(transactions: TransactionHistory, history: StockHistory = None, reinvest=False, since=None, s=0):
+        # Shares after each transaction and reinvested dividend. With since, only the events from since on,
+        # starting from the s shares held before it.
+        events = Stock._share_events(transactions, history, reinvest, since)
+        dividend_type = history.dividend.type if reinvest and history.dividend is not None else None
+        # The closes of the cash events in one batched as-of lookup
+        cash_transactions = transactions.type == TransactionType.Cash
+        cash_dividends = dividend_type == TransactionType.Cash
+        cash = [cash_transactions if is_transaction else cash_dividends for k, is_transaction, amount in events]
+        days = [e[0] for e, c in zip(events, cash) if c]
+        closes = iter([row.close for row in history.get_latest_many(days)] if days else [])
+        prices = [next(closes) if c else None for c in cash]
+        return DateSeries(zip([e[0] for e in events],
+                              Stock._replay_shares(events, prices, transactions.type, dividend_type, s)))
 
-            for k in sorted(transactions):
-                # Calculate dividend up to k
-                if i < len(div_dates):
-                    while k >= div_dates[i]:
-                        # Reinvest dividend
-                        if history.dividend.type == TransactionType.Shares:
-                            s += s * history.dividend[div_dates[i]]
-                        elif history.dividend.type == TransactionType.Cash:
-                            price = history.get_latest(div_dates[i]).close
-                            s += s * history.dividend[div_dates[i]] / price
-                        else:
-                            # Unsupported transaction type
-                            pass
-                        shares[div_dates[i]] = s
-                        i += 1
-                        if i >= len(div_dates):
-                            break
-                # Process transaction
-                if transactions.type == TransactionType.Shares:
-                    s += transactions[k]
-                elif transactions.type == TransactionType.Cash:
-                    # TODO: Handle exceptions
-                    price = history.get_latest(k).close
-                    s += transactions[k] / price
-                else:
-                    # Unsupported transaction type
-                    pass
-                shares[k] = s
-
-            # Calculate dividend after last transaction
-            while i < len(div_dates):
-                # Reinvest dividend
-                if history.dividend.type == TransactionType.Shares:
-                    s += s * history.dividend[div_dates[i]]
-                elif history.dividend.type == TransactionType.Cash:
-                    price = history.get_latest(div_dates[i]).close
-                    s += s * history.dividend[div_dates[i]] / price
-                else:
-                    # Unsupported transaction type
-                    pass
-                shares[div_dates[i]] = s
-                i += 1
+    @staticmethod
+    def _share_events(transactions: TransactionHistory, history: StockHistory = None, reinvest=False, since=None):
+        # (date, is_transaction, amount) of the transactions and reinvested dividends in order. Dividends before
+        # the first transaction do not apply (no shares), a dividend comes before a transaction on the same date.
+        first = min(transactions)
+        events = [(k, 1, transactions[k]) for k in sorted(transactions)]
+        if reinvest and history.dividend is not None:
+            dividend = history.dividend
+            events = list(merge([(k, 0, dividend[k]) for k in sorted(dividend) if k >= first], events))
+        if since is not None:
+            events = events[bisect_left(events, (since,)):]
+        return events
 
-        else:
-            for k in sorted(transactions):
-                if transactions.type == TransactionType.Shares:
-                    s += transactions[k]
-                elif transactions.type == TransactionType.Cash:
-                    # TODO: Handle exceptions
-                    price = history.get_latest(k).close
-                    s += transactions[k] / price
-                else:
-                    # Unsupported transaction type
-                    pass
-                shares[k] = s
+    @staticmethod
+    def _replay_shares(events, prices, transaction_type, dividend_type, s=0):
+        # Shares after each event starting from s, prices has the close of each event paid in cash. Reinvested
+        # dividends compound on the running shares, so this is a single pass in order.
+        # TODO: Handle exceptions
+        shares = []
+        append = shares.append
+        share_transactions = transaction_type == TransactionType.Shares
+        cash_transactions = transaction_type == TransactionType.Cash
+        share_dividends = dividend_type == TransactionType.Shares
+        cash_dividends = dividend_type == TransactionType.Cash
+        # Unsupported transaction types leave the shares unchanged
+        for (k, is_transaction, amount), price in zip(events, prices):
+            if is_transaction:
+                if share_transactions:
+                    s += amount
+                elif cash_transactions:
+                    s += amount / price
+            elif share_dividends:
+                s += s * amount
+            elif cash_dividends:
+                s += s * amount / price
+            append(s)
         return shares
 
+    @profiled("calc_cost")
     def calc_cost(self):
-        self.cost = self._calc_cost(self.transactions, self.history)
+        rates = self._rates()
+        self.cost = self._memoize("cost", lambda: self._calc_cost(self.transactions, self.history, rates=rates),
+                                  self.transactions, self.history.fingerprint(), *self._fx_inputs())
         return self.cost
 
     @staticmethod
-    def _calc_cost(transactions: TransactionHistory, history: StockHistory = None):
-        cost = {}
-        s = 0
-        for k in sorted(transactions):
+    def _calc_cost(transactions: TransactionHistory, history: StockHistory = None, since=None, s=0, rates=None):
+        # With since, only the transactions from since on, starting from the cost s before it. With rates (a
+        # RateIndex), each transaction is converted at the rate of its day.
+        cost = DateSeries()
+        keys = sorted(transactions)
+        if since is not None:
+            keys = keys[bisect_left(keys, since):]
+        for k, rate in zip(keys, rates.join(keys) if rates is not None else [None] * len(keys)):
             if transactions.type == TransactionType.Shares:
                 # TODO: Handle exceptions
-                s += transactions[k] * history[k].close
+                amount = transactions[k] * history[k].close
             elif transactions.type == TransactionType.Cash:
-                s += transactions[k]
+                amount = transactions[k]
             else:
                 # Unsupported transaction type
-                pass
+                amount = 0
+            s += amount if rate is None else amount * rate
             cost[k] = s
         return cost
 
+    @profiled("calc_value")
     def calc_value(self):
-        self.value = self._calc_value(self.shares, self.history)
+        rates = self._rates()
+        self.value = self._memoize("value", lambda: self._convert(self._calc_value(self.shares, self.history), rates),
+                                   self._input_key("shares"), self.history.fingerprint(), *self._fx_inputs())
         return self.value
 
+    def _rates(self):
+        # RateIndex from the currency of the stock to the base currency, None without conversion
+        if self.fx is None or self.currency is None or self.base is None or self.currency == self.base:
+            return None
+        return self.fx.index(self.currency, self.base)
+
+    def _fx_inputs(self):
+        return () if self._rates() is None else (self.fx.fingerprint(self.currency, self.base),)
+
+    @staticmethod
+    def _convert(series, rates):
+        # Each value times the rate as of its day, zeros stay as they are
+        if rates is None:
+            return series
+        days = series.dates()
+        return DateSeries((d, series[d] * r if series[d] else series[d]) for d, r in zip(days, rates.join(days)))
+
     @staticmethod
-    def _calc_value(shares, history: StockHistory, until: date = None):
+    def _calc_value(shares, history: StockHistory, until: date = None, since: date = None):
+        # With since, only the days from since on
+        calendar = Stock._calendar(history)
         if until is None:
-            until = max(history)
-        value = {}
-        date = min(shares)
+            until = calendar.dates[-1]
+        value = DateSeries()
+        keys = Stock._as_series(shares).dates()
+        if since is None or since <= keys[0]:
+            since = date = keys[0]
+        else:
+            keys = keys[bisect_right(keys, since) - 1:]
+            date = since
         # s = 0
-        for k in sorted(shares):
-            while date < k:
+        for k in keys:
+            if date < k:
                 # TODO: Handle exceptions
                 if s == 0:
-                    value[date] = 0
+                    # Every calendar day up to the change
+                    for d in map(date.fromordinal, range(date.toordinal(), k.toordinal())):
+                        value[d] = 0
                 else:
-                    if date in history:
-                        value[date] = s * history[date].close
-                date += timedelta(1)
+                    for d in calendar.between(date, k):
+                        value[d] = s * history[d].close
+                date = k
             s = shares[k]
-            value[k] = s * history.get_latest(k).close
+            if k >= since:
+                value[k] = s * history.get_latest(k).close
 
-        for d in [d for d in history if (d > date) and (d <= until)]:
-            value[d] = s * history[d].close  # ordered()?
+        # After the last change, up to until
+        start = max(calendar.until(keys[-1]), calendar.before(since))
+        for d in calendar.dates[start:calendar.until(until)]:
+            value[d] = s * history[d].close
         return value
 
+    @staticmethod
+    def _calendar(history):
+        if isinstance(history, StockHistory):
+            return history.calendar()
+        return TradingCalendar.of(Stock._as_series(history).dates())
+
+    @profiled("calc_gain")
     def calc_gain(self):
-        self.gain = self._calc_gain(self.value, self.cost)
+        self.gain = self._memoize("gain", lambda: self._calc_gain(self.value, self.cost),
+                                  self._input_key("value"), self._input_key("cost"))
         return self.gain
 
     @staticmethod
-    def _calc_gain(value, cost):
-        gain = {}
-        date = max([min(value), min(cost)])
-        # c = 0
-        for k in sorted(cost):
-            while date < k:
-                if date in value:
-                    gain[date] = value[date] - c
-                date += timedelta(1)
-            c = cost[k]
-        if date in value:
-            gain[date] = value[date] - c
-        for d in [d for d in value if (d > date)]:
+    def _calc_gain(value, cost, since=None):
+        # Value less the cost as of each day. With since, only the days from since on.
+        value = Stock._as_series(value)
+        cost = Stock._as_series(cost)
+        gain = DateSeries()
+        start = max([value.dates()[0], cost.dates()[0]])
+        if since is not None and since > start:
+            start = since
+        days = value.dates()[bisect_left(value.dates(), start):]
+        for d, c in zip(days, cost.get_latest_many(days)):
             gain[d] = value[d] - c
         return gain
 
+    @profiled("calc_gainp")
     def calc_gainp(self):
-        self.gainp = self._calc_gainp(self.gain, self.cost)
+        self.gainp = self._memoize("gainp", lambda: self._calc_gainp(self.gain, self.cost),
+                                   self._input_key("gain"), self._input_key("cost"))
         return self.gainp
 
+    def _memoize(self, name, calc, *inputs):
+        # calc(), or with a result cache the series calculated before from the same inputs
+        if self.result_cache is None:
+            return calc()
+        key, series = self.result_cache.memoize(name, calc, *inputs)
+        self._result_keys[name] = (series, key)
+        return series
+
+    def _input_key(self, name):
+        # Fingerprint of a series as an input: the result cache key it was calculated for, else its content
+        series = getattr(self, name)
+        known = self._result_keys.get(name)
+        if known is not None and known[0] is series:
+            return known[1]
+        return fingerprint(series)
+
     @staticmethod
-    def _calc_gainp(gain, cost):
-        gainp = {}
-        date = max([min(gain), min(cost)])
-        c = 0
-        for k in sorted(cost):
-            if c != 0:
-                while date < k:
-                    if date in gain:
-                        gainp[date] = gain[date] / c
-                    date += timedelta(1)
-            c = cost[k]
-        if c != 0:
-            if date in gain:
-                gainp[date] = gain[date] / c
-            for d in [d for d in gain if (d > date)]:
+    def _calc_gainp(gain, cost, since=None):
+        # Gain over the cost as of each day, days under a zero cost use the next non-zero cost (none if there
+        # is no later one). With since, only the days from since on.
+        gain = Stock._as_series(gain)
+        cost = Stock._as_series(cost)
+        gainp = DateSeries()
+        divisor = Stock._calc_divisor(cost)
+        start = max([gain.dates()[0], cost.dates()[0]])
+        if since is not None and since > start:
+            start = since
+        days = gain.dates()[bisect_left(gain.dates(), start):]
+        for d, c in zip(days, divisor.get_latest_many(days)):
+            if c is not None:
                 gainp[d] = gain[d] / c
         return gainp
 
+    @staticmethod
+    def _calc_divisor(cost):
+        # The cost gainp divides by from each cost change on: the next non-zero cost, None if there is none
+        keys = cost.dates()
+        divisor = []
+        c = None
+        for k in reversed(keys):
+            if cost[k] != 0:
+                c = cost[k]
+            divisor.append(c)
+        return DateSeries(zip(reversed(keys), divisor))
+
     def calc(self):
+        self.version += 1
+        if self.lazy:
+            self.shares = self.cost = self.value = self.gain = self.gainp = self.data = None
+            self.columns = self._divisor = None
+            return
+        if self.columnar:
+            self.calc_columnar()
+            return
         self.calc_shares()
         self.calc_value()
         self.calc_cost()
@@ -338,60 +1789,380 @@ class Stock:
         self.calc_gainp()
         self.calc_data()
 
-    def output(self, output):
+    def append(self, history=None, dividend=None, transactions=None):
+        # Adds history rows, dividends and transactions (date keyed) and recalculates only from the first date
+        # they affect, continuing from the shares and cost held before it
+        changed = []
+        if history:
+            for k in sorted(history):
+                self.history[k] = history[k]
+            changed.append(min(history))
+        if dividend:
+            if self.history.dividend is None:
+                self.history.init_dividend()
+            for k in sorted(dividend):
+                self.history.dividend[k] = dividend[k]
+            changed.append(min(dividend))
+        if transactions:
+            for k in sorted(transactions):
+                self.transactions[k] = transactions[k]
+            changed.append(min(transactions))
+        if not changed:
+            return
+        self.version += 1
+        self.columns = None
+        # The series change in place below
+        self._result_keys.clear()
+        if self.lazy:
+            self.calc()
+            return
+        since = min(changed)
+        if date.min in self.shares or since <= self.shares.dates()[0] or since <= self.cost.dates()[0]:
+            # Not calculated yet, or the start changes
+            self.calc()
+            return
+        before = since - timedelta(1)
+
+        shares = self._calc_shares(self.transactions, self.history, self.reinvest, since,
+                                   self.shares.get_latest(before))
+        self.shares.truncate(since)
+        self.shares.extend(shares)
+
+        rates = self._rates()
+        cost = self._calc_cost(self.transactions, self.history, since, self.cost.get_latest(before), rates)
+        self.cost.truncate(since)
+        self.cost.extend(cost)
+
+        # Without shares, the days up to the next change are all 0, so a later change reaches back to the last one
+        last = self.shares.dates()[bisect_left(self.shares.dates(), since) - 1]
+        if self.shares[last] == 0:
+            since = last
+        value = self._convert(self._calc_value(self.shares, self.history, since=since), rates)
+        self.value.truncate(since)
+        self.value.extend(value)
+
+        gain = self._calc_gain(self.value, self.cost, since)
+        self.gain.truncate(since)
+        self.gain.extend(gain)
+
+        # Days under a zero cost take the next non-zero cost, so a later cost reaches back over them
+        keys = self.cost.dates()
+        i = max(bisect_left(keys, since) - 1, 0)
+        while i > 0 and self.cost[keys[i - 1]] == 0:
+            i -= 1
+        if self.cost[keys[i]] == 0:
+            since = keys[i]
+        gainp = self._calc_gainp(self.gain, self.cost, since)
+        self.gainp.truncate(since)
+        self.gainp.extend(gainp)
+
+        self.calc_data(since)
+
+    @profiled("calc_columnar", lambda stock, result: len(stock.data))
+    def calc_columnar(self):
+        # Same results as the dict path, computed with array operations on the columnar history
+        require_numpy()
+        history = self.history.columns()
+        h = history.date.astype(np.int64)
+        close = history.close
+
+        sd, shares = self._calc_shares_columns(self.transactions, self.history, h, close, self.reinvest)
+        rates = self._rates()
+        vd, value, zero = self._calc_value_columns(sd, shares, h, close)
+        cd, cost = self._calc_cost_columns(self.transactions, h, close, rates)
+        if rates is not None:
+            value = value * rates.join_columns(vd)
+        gd, gain = self._calc_gain_columns(vd, value, cd, cost)
+        pd, gainp = self._calc_gainp_columns(gd, gain, cd, cost)
+
+        self.columns = {"shares": Stock.SeriesColumns(sd.astype("datetime64[D]"), shares),
+                        "value": Stock.SeriesColumns(vd.astype("datetime64[D]"), value),
+                        "cost": Stock.SeriesColumns(cd.astype("datetime64[D]"), cost),
+                        "gain": Stock.SeriesColumns(gd.astype("datetime64[D]"), gain),
+                        "gainp": Stock.SeriesColumns(pd.astype("datetime64[D]"), gainp)}
+
+        dates = from_days(vd)
+        # The dict path stores days without shares as integer 0
+        values = value.tolist()
+        for i in np.flatnonzero(zero).tolist():
+            values[i] = 0
+        self.shares = DateSeries(zip(from_days(sd), shares.tolist()))
+        self.value = DateSeries(zip(dates, values))
+        self.cost = DateSeries(zip(from_days(cd), cost.tolist()))
+        self.gain = DateSeries(zip(from_days(gd), gain.tolist()))
+        self.gainp = DateSeries(zip(from_days(pd), gainp.tolist()))
+        self.data = OrderedDict(zip(dates, map(Stock.StockData,
+                                               self._latest_columns(sd, shares, vd),
+                                               values,
+                                               self._latest_columns(cd, cost, vd),
+                                               self._latest_columns(gd, gain, vd),
+                                               self._latest_columns(pd, gainp, vd))))
+
+    @staticmethod
+    def _latest_columns(days, values, query):
+        # As-of lookup of each query day, None before the first day
+        if len(days) == 0:
+            return [None] * len(query)
+        i = np.searchsorted(days, query, side="right") - 1
+        result = values[i].tolist()
+        for j in np.flatnonzero(i < 0).tolist():
+            result[j] = None
+        return result
+
+    @staticmethod
+    def _latest_close(h, close, days):
+        i = np.searchsorted(h, days, side="right") - 1
+        return np.where(i >= 0, close[i], np.nan)
+
+    @staticmethod
+    def _calc_shares_columns(transactions: TransactionHistory, history: StockHistory, h, close, reinvest=False):
+        if reinvest and history.dividend is not None:
+            # Closes of all events in one batched as-of join, then the shares replayed in order
+            events = Stock._share_events(transactions, history, reinvest)
+            t = to_days([e[0] for e in events])
+            prices = Stock._latest_close(h, close, t).tolist()
+            shares = Stock._replay_shares(events, prices, transactions.type, history.dividend.type)
+            # A dividend and a transaction on one day are one row with the shares after both, like the dict path
+            last = np.append(t[1:] != t[:-1], True)
+            return t[last], np.array(shares, dtype=np.float64)[last]
+        dates = sorted(transactions)
+        t = to_days(dates)
+        amount = np.array([transactions[d] for d in dates], dtype=np.float64)
+        if transactions.type == TransactionType.Cash:
+            amount = amount / Stock._latest_close(h, close, t)
+        elif transactions.type != TransactionType.Shares:
+            # Unsupported transaction type
+            amount = np.zeros(len(t))
+        return t, np.cumsum(amount)
+
+    @staticmethod
+    def _calc_cost_columns(transactions: TransactionHistory, h, close, rates=None):
+        dates = sorted(transactions)
+        t = to_days(dates)
+        amount = np.array([transactions[d] for d in dates], dtype=np.float64)
+        if transactions.type == TransactionType.Shares:
+            i = np.minimum(np.searchsorted(h, t), len(h) - 1)
+            missing = np.flatnonzero(h[i] != t)
+            if len(missing):
+                raise KeyError(dates[missing[0]])
+            amount = amount * close[i]
+        elif transactions.type != TransactionType.Cash:
+            # Unsupported transaction type
+            amount = np.zeros(len(t))
+        if rates is not None:
+            amount = amount * rates.join_columns(t)
+        return t, np.cumsum(amount)
+
+    @staticmethod
+    def _calc_value_columns(sd, shares, h, close, until=None):
+        # Returns value days, values and a mask of the days the dict path stores as integer 0
+        if until is None:
+            until = h[-1]
+        last = len(sd) - 1
+        held = shares[:-1] != 0
+        # Trading days between share changes while shares are held, and after the last change up to until
+        j = np.searchsorted(sd, h, side="right") - 1
+        jc = np.maximum(j, 0)
+        inside = (j >= 0) & (h != sd[jc]) & np.where(j == last, h <= until, np.append(held, True)[jc])
+        # Every calendar day between share changes while no shares are held
+        gaps = np.flatnonzero(~held)
+        start = sd[gaps] + 1
+        length = sd[gaps + 1] - start
+        empty = np.arange(length.sum()) + np.repeat(start - (np.cumsum(length) - length), length)
+
+        days = np.concatenate((sd, h[inside], empty))
+        value = np.concatenate((shares * Stock._latest_close(h, close, sd), shares[jc[inside]] * close[inside],
+                                np.zeros(len(empty))))
+        zero = np.concatenate((np.append(~held, False), np.zeros(len(days) - len(sd) - len(empty), dtype=bool),
+                               np.ones(len(empty), dtype=bool)))
+        order = np.argsort(days, kind="stable")
+        return days[order], value[order], zero[order]
+
+    @staticmethod
+    def _calc_gain_columns(vd, value, cd, cost):
+        keep = vd >= max(vd[0], cd[0])
+        i = np.searchsorted(cd, vd[keep], side="right") - 1
+        return vd[keep], value[keep] - cost[i]
+
+    @staticmethod
+    def _calc_gainp_columns(gd, gain, cd, cost):
+        keep = gd >= max(gd[0], cd[0])
+        i = np.searchsorted(cd, gd[keep], side="right") - 1
+        # Days under a zero cost are divided by the next non-zero cost, like the dict path
+        n = len(cost)
+        nonzero = np.where(cost != 0, np.arange(n), n)
+        c = np.minimum.accumulate(nonzero[::-1])[::-1][i]
+        ok = c < n
+        return gd[keep][ok], gain[keep][ok] / cost[c[ok]]
+
+    @profiled("output", lambda stock, result: len(stock.value))
+    def output(self, output, period=None):
+        # With period, the last day of each period only, see resample
         csvwriter = csv.writer(output)
+        if period is None:
+            def items(name):
+                return Stock._sorted_items(getattr(self, name))
+        else:
+            table = self.resample(period)
+
+            def items(name):
+                return ((d, getattr(row, name)) for d, row in table.items() if getattr(row, name) is not None)
 
         print(file=output)
         print("---- Shares ----", file=output)
         csvwriter.writerow(["Date", "Shares"])
-        csvwriter.writerows(sorted(self.shares.items()))
+        csvwriter.writerows(items("shares"))
 
         print(file=output)
         print("---- Value ----", file=output)
         csvwriter.writerow(["Date", "Value"])
-        csvwriter.writerows(sorted(self.value.items()))
+        csvwriter.writerows(items("value"))
 
         print(file=output)
         print("---- Cost ----", file=output)
         csvwriter.writerow(["Date", "Cost"])
-        csvwriter.writerows(sorted(self.cost.items()))
+        csvwriter.writerows(items("cost"))
 
         print(file=output)
         print("---- Gain ----", file=output)
         csvwriter.writerow(["Date", "Gain"])
-        csvwriter.writerows(sorted(self.gain.items()))
+        csvwriter.writerows(items("gain"))
 
         print(file=output)
         print("---- Gain (%) ----", file=output)
         csvwriter.writerow(["Date", "Gain (%)"])
-        csvwriter.writerows(sorted(self.gainp.items()))
-
-    def calc_data(self):
-        self.data = OrderedDict(dict.fromkeys(sorted(self.value.keys())))
-        for k in self.data.keys():
-            self.data[k] = self._calc_data(k)
+        csvwriter.writerows(items("gainp"))
+
+    def export(self, output, format=ExportFormat.CSV, period=None):
+        # Stock.data as one wide table, see StockWriter
+        StockWriter(output, format, period=period).write(self)
+
+    def resample(self, period):
+        # The data rows of the last day of each period, without recalculating the daily series
+        dates = Stock._as_series(self.value).dates()
+        data = self.data
+        return OrderedDict((dates[i], data[dates[i]]) for i in period_ends(dates, period))
+
+    def metrics(self, window=21, periods=252, riskfree=0.0):
+        # Performance metrics of the calculated data, see Metrics
+        metrics = Metrics(window, periods, riskfree, self.cash_flows())
+        return metrics.extend((d, row.value, row.cost) for d, row in self.data.items())
+
+    def cash_flows(self):
+        # Transactions as (date, cash) paid into the stock as negative amounts, shares at the close of their day.
+        # Converted to the base currency at the rate of their day, like the cost.
+        rates = self._rates()
+        keys = self.transactions.dates()
+        flows = []
+        for k, rate in zip(keys, rates.join(keys) if rates is not None else [None] * len(keys)):
+            if self.transactions.type == TransactionType.Shares:
+                amount = self.transactions[k] * self.history[k].close
+            elif self.transactions.type == TransactionType.Cash:
+                amount = self.transactions[k]
+            else:
+                # Unsupported transaction type
+                continue
+            flows.append((k, -amount if rate is None else -amount * rate))
+        return flows
+
+    @profiled("calc_data", lambda stock, result: len(stock.data))
+    def calc_data(self, since=None):
+        # With since, only the days from since on are replaced
+        if since is None:
+            self.data = self._memoize("data", self._calc_all_data,
+                                      *(self._input_key(name) for name in ("shares", "value", "cost", "gain", "gainp")))
+            return
+        dates = Stock._as_series(self.value).dates()
+        dates = dates[bisect_left(dates, since):]
+        while self.data and next(reversed(self.data)) >= since:
+            self.data.popitem()
+        self.data.update(zip(dates, map(Stock.StockData, *self._data_columns(dates))))
+
+    def _calc_all_data(self):
+        dates = Stock._as_series(self.value).dates()
+        return OrderedDict(zip(dates, map(Stock.StockData, *self._data_columns(dates))))
+
+    def _data_columns(self, dates):
+        return [Stock._as_series(s).get_latest_many(dates)
+                for s in (self.shares, self.value, self.cost, self.gain, self.gainp)]
 
     def _calc_data(self, date):
         return Stock.StockData(self.get_shares(date), self.get_value(date), self.get_cost(date), self.get_gain(date),
                                self.get_gainp(date))
 
     def get_gainp(self, date):
+        if self.lazy and self._gainp is None:
+            return self._point_gainp(date)
         return Stock._get_latest(self.gainp, date)
 
     def get_gain(self, date):
+        if self.lazy and self._gain is None:
+            day, value = self._point_value(date)
+            return None if day is None or day < self._point_start() else value - self.cost.get_latest(date)
         return Stock._get_latest(self.gain, date)
 
     def get_cost(self, date):
         return Stock._get_latest(self.cost, date)
 
     def get_value(self, date):
+        if self.lazy and self._value is None:
+            return self._point_value(date)[1]
         return Stock._get_latest(self.value, date)
 
     def get_shares(self, date):
         return Stock._get_latest(self.shares, date)
 
+    def _point_value(self, date):
+        # The last day of the value series on or before date and its value, (None, None) before it
+        keys = self.shares.dates()
+        i = bisect_right(keys, date) - 1
+        if i < 0:
+            return None, None
+        s = self.shares[keys[i]]
+        if s == 0 and i < len(keys) - 1:
+            # Every day up to the next change is 0
+            return date, 0
+        calendar = self.history.calendar()
+        h = calendar.dates[calendar.until(date) - 1]
+        # Between changes the value series only has the history days
+        day = max(h, keys[i])
+        value = s * self.history[h].close
+        rates = self._rates()
+        return day, value if rates is None or not value else value * rates.join([day])[0]
+
+    def _point_start(self):
+        return max(self.shares.dates()[0], self.cost.dates()[0])
+
+    def _point_gainp(self, date):
+        if self._divisor is None:
+            self._divisor = self._calc_divisor(self.cost)
+        day, value = self._point_value(date)
+        if day is None or day < self._point_start():
+            return None
+        c = self._divisor.get_latest(day)
+        if c is None:
+            # No non-zero cost from here on, the last gainp is from the day before the zero cost started
+            keys = self.cost.dates()
+            i = bisect_right(keys, day) - 1
+            while i > 0 and self._divisor[keys[i - 1]] is None:
+                i -= 1
+            return self._point_gainp(keys[i] - timedelta(1)) if i > 0 else None
+        return (value - self.cost.get_latest(date)) / c
+
+    @staticmethod
+    def _sorted_items(series):
+        # Items in date order from the index of the series
+        series = Stock._as_series(series)
+        return ((d, series[d]) for d in series.dates())
+
+    @staticmethod
+    def _as_series(d: dict):
+        return d if isinstance(d, DateSeries) else DateSeries(d)
+
     @staticmethod
     def _get_latest(d: dict, date: date):
+        if isinstance(d, DateSeries):
+            return d.get_latest(date)
         if date in d:
             return d[date]
         elif date > min(d.keys()):
@@ -400,10 +2171,557 @@ class Stock:
             return None
 
 
+class StockWriter:
+    # Streams the data of calculated stocks as one wide table with a row per date (and symbol): CSV,
+    # newline-delimited JSON or binary columns. Rows are formatted and written a chunk at a time.
+    # Binary output is a file header followed by a block per chunk: the row count and symbol length, the UTF-8
+    # symbol, int64 days since 1970-01-01 and a float64 column per series (NaN for None).
+    COLUMNS = ("date", "shares", "value", "cost", "gain", "gainp")
+    HEADER = struct.Struct("=8s8s")  # magic, kind
+    BLOCK = struct.Struct("=qq")  # rows, symbol length
+    KIND = b"X" + sys.byteorder[0].encode()
+    ExportColumns = namedtuple("ExportColumns", "symbol, date, shares, value, cost, gain, gainp")
+    ExportColumns.__qualname__ = "StockWriter.ExportColumns"
+
+    def __init__(self, output, format=ExportFormat.CSV, symbols=False, chunk=4096, period=None):
+        # output: a text file, or a binary file for ExportFormat.BINARY. symbols adds a symbol column, period
+        # keeps the last day of each period only.
+        self.output = output
+        self.period = period
+        self.format = format
+        self.symbols = symbols
+        self.chunk = chunk
+        self.columns = (("symbol",) if symbols else ()) + StockWriter.COLUMNS
+        if format == ExportFormat.CSV:
+            csv.writer(output).writerow(self.columns)
+        elif format == ExportFormat.BINARY:
+            output.write(StockWriter.HEADER.pack(HistoryCache.MAGIC, StockWriter.KIND))
+
+    @profiled("export", lambda writer, result: result)
+    def write(self, stock, symbol=None):
+        # Returns the number of rows written
+        if self.period is None:
+            items = iter(stock.data.items())
+        else:
+            items = iter(Stock.resample(stock, self.period).items())
+        count = 0
+        rows = list(islice(items, self.chunk))
+        while rows:
+            count += len(rows)
+            if self.format == ExportFormat.CSV:
+                self._write_csv(rows, symbol)
+            elif self.format == ExportFormat.NDJSON:
+                self._write_ndjson(rows, symbol)
+            elif self.format == ExportFormat.BINARY:
+                self._write_binary(rows, symbol)
+            rows = list(islice(items, self.chunk))
+        return count
+
+    def _write_csv(self, rows, symbol):
+        buffer = io.StringIO()
+        if self.symbols:
+            csv.writer(buffer).writerows((symbol, d) + tuple(data) for d, data in rows)
+        else:
+            csv.writer(buffer).writerows((d,) + tuple(data) for d, data in rows)
+        self.output.write(buffer.getvalue())
+
+    def _write_ndjson(self, rows, symbol):
+        prefix = (symbol,) if self.symbols else ()
+        columns = self.columns
+        self.output.write("".join(json.dumps(dict(zip(columns, prefix + (d.isoformat(),) + tuple(data)))) + "\n"
+                                  for d, data in rows))
+
+    def _write_binary(self, rows, symbol):
+        nan = float("nan")
+        name = ("" if symbol is None else str(symbol)).encode()
+        self.output.write(StockWriter.BLOCK.pack(len(rows), len(name)) + name)
+        self.output.write(array("q", [d.toordinal() - EPOCH_ORDINAL for d, data in rows]).tobytes())
+        for column in zip(*(data for d, data in rows)):
+            self.output.write(array("d", [nan if v is None else v for v in column]).tobytes())
+
+    @staticmethod
+    def read(input):
+        # Yields an ExportColumns per block of binary output, with the dates as a list and array("d") columns
+        magic, kind = StockWriter.HEADER.unpack(input.read(StockWriter.HEADER.size))
+        if magic != HistoryCache.MAGIC or kind.rstrip(b"\0") != StockWriter.KIND:
+            raise ValueError("Not a StockSim binary export")
+        while True:
+            block = input.read(StockWriter.BLOCK.size)
+            if not block:
+                break
+            rows, length = StockWriter.BLOCK.unpack(block)
+            symbol = input.read(length).decode()
+            days = array("q", input.read(rows * 8))
+            columns = [array("d", input.read(rows * 8)) for _ in range(5)]
+            yield StockWriter.ExportColumns(symbol, from_ordinals(days), *columns)
+
+
+class ScenarioBatch:
+    # What-if analysis: many transaction plans (each with or without reinvestment) against one history and its
+    # dividends. Scenarios are evaluated a block at a time as scenarios x events and scenarios x trading days
+    # matrices: one as-of join for the closes of all events, the shares and cost accumulated along the rows and
+    # the daily rows gathered from the last event on or before each day. Only reinvested dividends, which
+    # compound on the running shares, step through the event columns. Needs numpy.
+    Scenario = namedtuple("Scenario", "name, transactions, reinvest")
+    Result = namedtuple("Result", "names, dates, summary, shares, value, cost, gain, gainp")
+    Scenario.__qualname__ = "ScenarioBatch.Scenario"
+    Result.__qualname__ = "ScenarioBatch.Result"
+    # Summary per scenario: the last shares, value, cost, gain and gainp, the highest value and the lowest gain
+    SUMMARY = ("shares", "value", "cost", "gain", "gainp", "max_value", "min_gain")
+    # Scenarios per block, bounds the size of the matrices
+    BLOCK = 256
+
+    def __init__(self, history: StockHistory, reinvest=True):
+        require_numpy()
+        self.history = history
+        self.reinvest = reinvest
+        columns = history.columns()
+        self.dates = columns.date
+        self.days = columns.date.astype(np.int64)
+        self.close = columns.close
+
+    def run(self, scenarios, series=False):
+        # scenarios: Scenario or TransactionHistory items (named by position, reinvest as set on the batch).
+        # Returns a Result with the summary as arrays by name and, with series, the matrices (NaN where a
+        # scenario has no value yet).
+        scenarios = [s if isinstance(s, ScenarioBatch.Scenario) else ScenarioBatch.Scenario(i, s, self.reinvest)
+                     for i, s in enumerate(scenarios)]
+        n = len(scenarios)
+        summary = OrderedDict((name, np.full(n, np.nan)) for name in ScenarioBatch.SUMMARY)
+        matrices = [np.full((n, len(self.days)), np.nan) for _ in range(5)] if series else [None] * 5
+        for i in range(0, n, ScenarioBatch.BLOCK):
+            rows = self._evaluate(scenarios[i:i + ScenarioBatch.BLOCK])
+            for matrix, block in zip(matrices, rows):
+                if matrix is not None:
+                    matrix[i:i + len(block)] = block
+            for name, block in zip(ScenarioBatch.SUMMARY, rows):
+                summary[name][i:i + len(block)] = block[:, -1]
+            summary["max_value"][i:i + len(rows[1])] = ScenarioBatch._reduce(np.max, rows[1], -np.inf)
+            summary["min_gain"][i:i + len(rows[3])] = ScenarioBatch._reduce(np.min, rows[3], np.inf)
+        return ScenarioBatch.Result([s.name for s in scenarios], self.dates, summary, *matrices)
+
+    def _evaluate(self, scenarios):
+        # Shares, value, cost, gain and gainp of each scenario on each trading day, like Stock.calc_columnar
+        h, close = self.days, self.close
+        events = [Stock._share_events(s.transactions, self.history, s.reinvest) for s in scenarios]
+        lengths = np.array([len(e) for e in events])
+        n, m = len(events), lengths.max()
+        # Row and column of each event, in order, and the events as padded matrices
+        row = np.repeat(np.arange(n), lengths)
+        col = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        flat = [e for scenario in events for e in scenario]
+        t = np.zeros((n, m), dtype=np.int64)
+        t[row, col] = to_days([e[0] for e in flat])
+        is_transaction = np.zeros((n, m), dtype=bool)
+        is_transaction[row, col] = [e[1] for e in flat]
+        is_dividend = np.zeros((n, m), dtype=bool)
+        is_dividend[row, col] = ~is_transaction[row, col]
+        amount = np.zeros((n, m))
+        amount[row, col] = [e[2] for e in flat]
+        price = Stock._latest_close(h, close, t)
+        types = [s.transactions.type for s in scenarios]
+        share_transactions = np.array([k == TransactionType.Shares for k in types])[:, None] & is_transaction
+        cash_transactions = np.array([k == TransactionType.Cash for k in types])[:, None] & is_transaction
+
+        # Shares after each event, unsupported transaction types leave them unchanged
+        add = np.where(cash_transactions, amount / np.where(cash_transactions, price, 1), 0)
+        add = np.where(share_transactions, amount, add)
+        if is_dividend.any():
+            dividend_type = self.history.dividend.type
+            after = np.empty((n, m))
+            s = np.zeros(n)
+            for j in range(m):
+                dividend = s * amount[:, j]
+                if dividend_type == TransactionType.Cash:
+                    dividend = dividend / price[:, j]
+                elif dividend_type != TransactionType.Shares:
+                    dividend = np.zeros(n)
+                s = s + np.where(is_dividend[:, j], dividend, add[:, j])
+                after[:, j] = s
+        else:
+            after = np.cumsum(add, axis=1)
+        # Cost after each event, shares are bought at the close of the day
+        i = np.minimum(np.searchsorted(h, t), len(h) - 1)
+        missing = np.argwhere(share_transactions & (h[i] != t))
+        if len(missing):
+            raise KeyError(events[missing[0][0]][missing[0][1]][0])
+        paid = np.cumsum(np.where(cash_transactions, amount, np.where(share_transactions, amount * close[i], 0)),
+                         axis=1)
+        # Days under a zero cost are divided by the next non-zero cost, like the dict path
+        nonzero = np.where((paid != 0) & (is_transaction | is_dividend), np.arange(m), m)
+        divisor = np.minimum.accumulate(nonzero[:, ::-1], axis=1)[:, ::-1]
+
+        # Last event on or before each trading day
+        last = np.full((n, len(h) + 1), -1)
+        np.maximum.at(last, (row, np.searchsorted(h, t[row, col])), col)
+        last = np.maximum.accumulate(last, axis=1)[:, :-1]
+        held = last >= 0
+        last = np.maximum(last, 0)
+        shares = np.where(held, np.take_along_axis(after, last, 1), np.nan)
+        cost = np.where(held, np.take_along_axis(paid, last, 1), np.nan)
+        value = shares * close
+        gain = value - cost
+        c = np.take_along_axis(divisor, last, 1)
+        gainp = gain / np.where(held & (c < m), np.take_along_axis(paid, np.minimum(c, m - 1), 1), np.nan)
+        return shares, value, cost, gain, gainp
+
+    @staticmethod
+    def _reduce(function, matrix, fill):
+        # Reduction of each row ignoring NaN, NaN for rows without values
+        missing = np.isnan(matrix)
+        return np.where(missing.all(axis=1), np.nan, function(np.where(missing, fill, matrix), axis=1))
+
+
+class Moments:
+    # Running mean and variance (Welford), values can be removed again for a sliding window
+    def __init__(self):
+        super(Moments, self).__init__()
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+
+    def remove(self, x):
+        self.n -= 1
+        if self.n == 0:
+            self.mean = self.m2 = 0.0
+            return
+        d = x - self.mean
+        self.mean -= d / self.n
+        self.m2 = max(0.0, self.m2 - d * (x - self.mean))
+
+    def variance(self):
+        # Sample variance, None below two values
+        return self.m2 / (self.n - 1) if self.n > 1 else None
+
+
+class Metrics:
+    # Performance of a value and cost series fed a day at a time in date order, in constant state apart from the
+    # window of the rolling volatility. The cost changes are the external cash flows, so the return of a day is
+    # (value - flow) / previous value - 1, and days after a zero value are skipped. The time-weighted growth gives
+    # the drawdown, volatility and Sharpe ratio are annualized by periods. XIRR is solved from the dated cash flows
+    # (negative when money goes in) and the last value.
+    Summary = namedtuple("Summary", "start, end, twr, xirr, max_drawdown, volatility, sharpe")
+    Summary.__qualname__ = "Metrics.Summary"
+
+    def __init__(self, window=21, periods=252, riskfree=0.0, flows=()):
+        super(Metrics, self).__init__()
+        self.window = window
+        self.periods = periods
+        # Risk-free return per period
+        self.riskfree = (1 + riskfree) ** (1 / periods) - 1
+        self.flows = list(flows)
+        self.start = None
+        self.end = None
+        self.value = 0
+        self.cost = 0
+        self.growth = 1.0
+        self.peak = 1.0
+        self.max_drawdown = 0.0
+        self.excess = Moments()
+        self.rolling = Moments()
+        self.returns = deque()
+        self.volatility = DateSeries()
+
+    def add(self, day, value, cost):
+        value = value or 0
+        cost = cost or 0
+        if self.start is None:
+            self.start = day
+        if self.value:
+            r = (value - (cost - self.cost)) / self.value - 1
+            self.growth *= 1 + r
+            self.peak = max(self.peak, self.growth)
+            self.max_drawdown = min(self.max_drawdown, self.growth / self.peak - 1)
+            self.excess.add(r - self.riskfree)
+            self.rolling.add(r)
+            self.returns.append(r)
+            if len(self.returns) > self.window:
+                self.rolling.remove(self.returns.popleft())
+            if len(self.returns) == self.window:
+                self.volatility[day] = math.sqrt(self.rolling.variance() * self.periods)
+        self.end = day
+        self.value = value
+        self.cost = cost
+
+    def extend(self, rows):
+        # rows: (date, value, cost) in date order
+        for row in rows:
+            self.add(*row)
+        return self
+
+    def summary(self):
+        variance = self.excess.variance()
+        volatility = None if variance is None else math.sqrt(variance * self.periods)
+        sharpe = self.excess.mean / math.sqrt(variance) * math.sqrt(self.periods) if variance else None
+        xirr = Metrics.xirr(self.flows + [(self.end, self.value)]) if self.flows and self.end is not None else None
+        return Metrics.Summary(self.start, self.end, self.growth - 1 if self.excess.n else None, xirr,
+                               self.max_drawdown, volatility, sharpe)
+
+    @staticmethod
+    def xirr(flows, guess=0.1, iterations=50, tolerance=1e-10):
+        # Annual rate at which the dated flows discount to 0 by Newton's method, None when it does not converge.
+        # A step to -100% or below goes halfway from the previous rate to -100% instead.
+        start = min(d for d, a in flows)
+        flows = [((d - start).days / 365.0, a) for d, a in flows if a]
+        if not flows:
+            return None
+        rate = guess
+        for _ in range(iterations):
+            try:
+                f = sum(a * (1 + rate) ** -t for t, a in flows)
+                df = sum(-t * a * (1 + rate) ** (-t - 1) for t, a in flows)
+            except OverflowError:
+                return None
+            if df == 0:
+                return None
+            step = f / df
+            new = rate - step
+            if new <= -1:
+                new = (rate - 1) / 2
+            if abs(new - rate) < tolerance:
+                return new
+            rate = new
+        return None
+
+    def output(self, output):
+        csvwriter = csv.writer(output)
+
+        print(file=output)
+        print("---- Metrics ----", file=output)
+        csvwriter.writerow(["Metric", "Value"])
+        csvwriter.writerows(self.summary()._asdict().items())
+
+        print(file=output)
+        print("---- Volatility ----", file=output)
+        csvwriter.writerow(["Date", "Volatility"])
+        csvwriter.writerows(Stock._sorted_items(self.volatility))
+
+
+StockResult = namedtuple("StockResult", "symbol, shares, value, cost, gain, gainp, data, profile",
+                         defaults=(None,))
+ManifestEntry = namedtuple("ManifestEntry", "symbol, history, transactions, dividend, mode")
+LoadedEntry = namedtuple("LoadedEntry", "symbol, stock, profile", defaults=(None,))
+
+
+def read_manifest(path):
+    # Per-symbol input files, either a CSV manifest (symbol,history,transactions[,dividend][,mode] with paths
+    # relative to it and mode csv or json) or a directory with a history.txt, transactions.csv and optional
+    # dividend.txt in a subdirectory per symbol
+    entries = []
+    if os.path.isdir(path):
+        for symbol in sorted(os.listdir(path)):
+            folder = os.path.join(path, symbol)
+            if os.path.isfile(os.path.join(folder, "history.txt")):
+                dividend = os.path.join(folder, "dividend.txt")
+                entries.append(ManifestEntry(symbol, os.path.join(folder, "history.txt"),
+                                             os.path.join(folder, "transactions.csv"),
+                                             dividend if os.path.isfile(dividend) else None, DataMode.CSV))
+        return entries
+    folder = os.path.dirname(path)
+    with open(path, newline="") as file:
+        rows = read_csv(file, ("symbol", "history", "transactions", "dividend", "mode"))
+        columns = next(rows, None)
+        for row in rows:
+            symbol, history, transactions, dividend, mode = (row[i] for i in columns)
+            entries.append(ManifestEntry(symbol, os.path.join(folder, history), os.path.join(folder, transactions),
+                                         os.path.join(folder, dividend) if dividend else None,
+                                         DataMode.JSON if mode and mode.strip().lower() == "json" else DataMode.CSV))
+    check_symbols(entries)
+    return entries
+
+
+def check_symbols(entries):
+    # Stocks are kept by symbol, a second entry for a symbol would replace the first
+    seen = set()
+    for entry in entries:
+        if entry.symbol in seen:
+            raise ValueError("Duplicate symbol in manifest: {}".format(entry.symbol))
+        seen.add(entry.symbol)
+
+
+def collect_profile(memory, function, *args):
+    # Calls function with the profile records collected here instead of reported (allocations traced with
+    # memory), for process pool tasks to return them with their result. Returns the result and the records.
+    callbacks = PROFILE_CALLBACKS[:]
+    del PROFILE_CALLBACKS[:]
+    try:
+        with Profiler(memory) as profiler:
+            result = function(*args)
+    finally:
+        PROFILE_CALLBACKS[:] = callbacks
+    return result, profiler.records
+
+
+def report_profiles(results):
+    # Reports the profile records that process pool tasks returned with their results
+    for result in results:
+        for record in result.profile or ():
+            report_profile(record)
+
+
+def calc_stock(stock, symbol=None, profile=False, memory=False):
+    # Process pool task: calculates stock and returns only the derived series, with profile the profile records
+    # too (see collect_profile)
+    if profile:
+        result, records = collect_profile(memory, calc_stock, stock, symbol)
+        return result._replace(profile=records)
+    with profile_symbol(symbol):
+        stock.calc()
+    return StockResult(symbol, stock.shares, stock.value, stock.cost, stock.gain, stock.gainp, stock.data)
+
+
+def calc_item(item, profile=False, memory=False):
+    # Process pool task: calc_stock of a (symbol, stock) item
+    symbol, stock = item
+    return calc_stock(stock, symbol, profile, memory)
+
+
+def calc_entry(entry, reinvest=True, columnar=False, cache=None, profile=False, memory=False):
+    # Process pool task: loads and calculates the stock of a manifest entry. With profile, the profile records
+    # are collected in the worker (allocations traced with memory) and returned with the result.
+    if profile:
+        result, records = collect_profile(memory, calc_entry, entry, reinvest, columnar, cache)
+        return result._replace(profile=records)
+    with profile_symbol(entry.symbol):
+        stock = Stock()
+        stock.load_files(entry.history, entry.transactions, entry.dividend, entry.mode, cache)
+        stock.reinvest = reinvest
+        stock.columnar = columnar
+        return calc_stock(stock, entry.symbol)
+
+
+def read_entry(entry):
+    # The manifest entry with the contents of its files in place of the paths
+    def read(path):
+        if path is None:
+            return None
+        with open(path, newline="") as file:
+            return file.read()
+    return entry._replace(history=read(entry.history), transactions=read(entry.transactions),
+                          dividend=read(entry.dividend))
+
+
+def load_entry(entry, cache=None, profile=False, memory=False):
+    # Process pool task: the LoadedEntry of a manifest entry, with profile its profile records too
+    if profile:
+        result, records = collect_profile(memory, load_entry, entry, cache)
+        return result._replace(profile=records)
+    stock = Stock()
+    with profile_symbol(entry.symbol):
+        stock.load_files(entry.history, entry.transactions, entry.dividend, entry.mode, cache)
+    return LoadedEntry(entry.symbol, stock)
+
+
+def parse_entry(entry, profile=False, memory=False):
+    # Process pool task: the LoadedEntry of a manifest entry from read_entry, with profile its profile records too
+    if profile:
+        result, records = collect_profile(memory, parse_entry, entry)
+        return result._replace(profile=records)
+    stock = Stock()
+    with profile_symbol(entry.symbol):
+        stock.load(entry.history, entry.transactions, entry.dividend, entry.mode)
+    return LoadedEntry(entry.symbol, stock)
+
+
+async def load_entries_async(entries, concurrency=16, processes=None, cache=None):
+    # Yields the LoadedEntry of each manifest entry as it is loaded. At most concurrency entries are in flight:
+    # their files are read in threads and parsed in a process pool, so the event loop never blocks. With cache,
+    # the workers read the files through the binary cache themselves. While profiling, the workers return their
+    # profile records with the stocks.
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    profile = bool(PROFILE_CALLBACKS)
+    memory = tracemalloc.is_tracing()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as threads, \
+            concurrent.futures.ProcessPoolExecutor(processes) as workers:
+        async def load(entry):
+            async with semaphore:
+                if cache is not None:
+                    return await loop.run_in_executor(workers, load_entry, entry, cache, profile, memory)
+                entry = await loop.run_in_executor(threads, read_entry, entry)
+                return await loop.run_in_executor(workers, parse_entry, entry, profile, memory)
+
+        tasks = [asyncio.ensure_future(load(entry)) for entry in entries]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def load_entries(entries, concurrency=16, processes=None, cache=None):
+    # The loaded stocks of the manifest entries by symbol in manifest order, see load_entries_async. The profile
+    # records of the workers are reported here.
+    check_symbols(entries)
+
+    async def collect():
+        return [loaded async for loaded in load_entries_async(entries, concurrency, processes, cache)]
+    loaded = asyncio.run(collect())
+    report_profiles(loaded)
+    stocks = {symbol: stock for symbol, stock, profile in loaded}
+    return OrderedDict((entry.symbol, stocks[entry.symbol]) for entry in entries)
+
+
+def run_pool(task, items, processes=None, initializer=None, initargs=()):
+    # Maps task over items in a process pool (inline with one process), results in order. initializer runs
+    # once in each worker.
+    if processes == 1 or len(items) < 2:
+        return list(map(task, items))
+    chunksize = max(1, len(items) // (4 * (processes or os.cpu_count() or 1)))
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=initializer, initargs=initargs) as executor:
+        return list(executor.map(task, items, chunksize=chunksize))
+
+
 class StockSim:
     def __init__(self):
         super(StockSim, self).__init__()
         self.stocks = [Stock()]
+        self.portfolio = Portfolio()
+        # base: currency every stock is valued in, with the exchange rates of fx
+        self.base = None
+        self.fx = FxRates()
+
+    def calc(self, processes=None):
+        # Calculates every stock in a process pool and aggregates them into the portfolio. The stocks keep their
+        # inputs, the derived series come back from the workers.
+        for stock in self.stocks:
+            stock.base = self.base
+            stock.fx = self.fx
+            # Builds the rate index of each pair once, here
+            stock._rates()
+        # The workers receive the rates and their indexes once, the stocks only refer to them
+        self.fx.token = "{}:{}".format(os.getpid(), id(self.fx))
+        task = functools.partial(calc_item, profile=bool(PROFILE_CALLBACKS), memory=tracemalloc.is_tracing())
+        try:
+            results = run_pool(task, list(enumerate(self.stocks)), processes, install_fx_rates,
+                               (self.fx.token, self.fx.histories, self.fx._indexes))
+        finally:
+            self.fx.token = None
+        report_profiles(results)
+        for stock, result in zip(self.stocks, results):
+            stock.shares, stock.value, stock.cost, stock.gain, stock.gainp, stock.data = result[1:7]
+        self.portfolio = Portfolio()
+        for i, stock in enumerate(self.stocks):
+            self.portfolio.add(i, stock)
+        self.portfolio.calc()
+        return self.portfolio
+
+    def share(self, store: PriceStore):
+        # Moves the histories of the stocks into the shared memory of store, calc() then sends only their names
+        for stock in self.stocks:
+            if not isinstance(stock.history, SharedHistory):
+                stock.history = store.put(stock.history)
+
+    def snapshot(self, dates):
+        # As-of table of every stock on dates, see Portfolio.snapshot
+        return self.portfolio.snapshot(dates)
 
     # Save
     # Load
@@ -414,13 +2732,457 @@ class StockSim:
 
 
 class Portfolio:
+    # As-of table of snapshot(): a row per symbol with a value per date for each series
+    Snapshot = namedtuple("Snapshot", "symbols, dates, shares, value, cost, gain, gainp")
+    Snapshot.__qualname__ = "Portfolio.Snapshot"
+    SERIES = ("shares", "value", "cost", "gain", "gainp")
+
     def __init__(self):
         super(Portfolio, self).__init__()
+        self.stocks = OrderedDict()
+        self._indexes = {}
         self.cost = {date.min: 0}
         self.value = {date.min: 0}
         self.gain = {date.min: 0}
         self.gainp = {date.min: 0}
 
+    def add(self, symbol, stock):
+        # stock: a calculated Stock or StockResult
+        self.stocks[symbol] = stock
+        self._indexes.pop(symbol, None)
+
+    def calc_entries(self, entries, processes=None, reinvest=True, columnar=False, cache=None):
+        # Loads and calculates the stocks of manifest entries in a process pool, then aggregates them. While
+        # profiling, the workers send their profile records back to be reported here.
+        check_symbols(entries)
+        task = functools.partial(calc_entry, reinvest=reinvest, columnar=columnar, cache=cache,
+                                 profile=bool(PROFILE_CALLBACKS), memory=tracemalloc.is_tracing())
+        results = run_pool(task, entries, processes)
+        report_profiles(results)
+        for result in results:
+            self.add(result.symbol, result._replace(profile=None))
+        self.calc()
+
+    def calc(self):
+        # Sums the value and cost of every stock as of each date any of them has a value on
+        stocks = list(self.stocks.values())
+        dates = sorted(set().union(*(s.value.keys() for s in stocks)))
+        value = Portfolio._sum_latest([s.value for s in stocks], dates)
+        cost = Portfolio._sum_latest([s.cost for s in stocks], dates)
+        self.value = DateSeries(zip(dates, value))
+        self.cost = DateSeries(zip(dates, cost))
+        self.gain = DateSeries((d, v - c) for d, v, c in zip(dates, value, cost))
+        self.gainp = DateSeries((d, (v - c) / c) for d, v, c in zip(dates, value, cost) if c != 0)
+
+    @staticmethod
+    def _sum_latest(series, dates):
+        # Sum of the as-of values of each series on dates, a series counts 0 before its first date
+        if np is not None and dates:
+            axis = to_days(dates)
+            total = np.zeros(len(dates))
+            for s in series:
+                s = Stock._as_series(s)
+                i = np.searchsorted(to_days(s.dates()), axis, side="right") - 1
+                values = np.array([s[d] for d in s.dates()] + [0], dtype=np.float64)
+                total += values[i]
+            return total.tolist()
+        total = [0] * len(dates)
+        for s in series:
+            for i, v in enumerate(Stock._as_series(s).get_latest_many(dates)):
+                if v is not None:
+                    total[i] += v
+        return total
+
+    def snapshot(self, dates, symbols=None):
+        # Shares, value, cost, gain and gainp of the stocks (default: all) as of each of dates, None before the
+        # first date of a series. Every series is looked up through an index built on first use and reused by
+        # later snapshots until the stock is added again or its series change.
+        dates = list(dates)
+        symbols = list(self.stocks) if symbols is None else list(symbols)
+        table = {name: [] for name in Portfolio.SERIES}
+        if np is not None:
+            axis = to_days(dates)
+            for symbol in symbols:
+                for name, (days, values) in zip(Portfolio.SERIES, self._index(symbol)):
+                    # Before the first date the position is -1, the None after the values
+                    table[name].append(values[np.searchsorted(days, axis, side="right") - 1].tolist())
+        else:
+            order = sorted(range(len(dates)), key=dates.__getitem__)
+            query = [dates[i] for i in order]
+            for symbol in symbols:
+                for name, series in zip(Portfolio.SERIES, self._index(symbol)):
+                    row = [None] * len(dates)
+                    for i, v in zip(order, series.get_latest_many(query)):
+                        row[i] = v
+                    table[name].append(row)
+        return Portfolio.Snapshot(symbols, dates, **table)
+
+    def _index(self, symbol):
+        # Per series of a stock: int64 days and the values with a trailing None, or the DateSeries without numpy.
+        # Rebuilt when a series of the stock was replaced or the stock changed them in place (see Stock.version).
+        stock = self.stocks[symbol]
+        raw = [getattr(stock, name) for name in Portfolio.SERIES]
+        version = getattr(stock, "version", None)
+        cached = self._indexes.get(symbol)
+        if cached is not None and all(a is b for a, b in zip(cached[0], raw)) and cached[1] == version:
+            return cached[2]
+        series = [Stock._as_series(s) for s in raw]
+        if np is not None:
+            index = [(to_days(s.dates()), np.array([s[d] for d in s.dates()] + [None], dtype=object))
+                     for s in series]
+        else:
+            for s in series:
+                s.dates()
+            index = series
+        self._indexes[symbol] = raw, version, index
+        return index
+
+    @staticmethod
+    def write_snapshot(snapshot, output):
+        # CSV with a row per symbol and date
+        csvwriter = csv.writer(output)
+        csvwriter.writerow(("Symbol", "Date", "Shares", "Value", "Cost", "Gain", "Gain (%)"))
+        for i, symbol in enumerate(snapshot.symbols):
+            for j, d in enumerate(snapshot.dates):
+                csvwriter.writerow((symbol, d) + tuple(getattr(snapshot, name)[i][j] for name in Portfolio.SERIES))
+
+    def metrics(self, window=21, periods=252, riskfree=0.0):
+        # Performance metrics of the portfolio series, see Metrics. The stocks may be results without their
+        # transactions, so the cash flows are the changes of the summed cost.
+        flows = []
+        cost = 0
+        for d, c in Stock._sorted_items(self.cost):
+            if c != cost:
+                flows.append((d, cost - c))
+            cost = c
+        metrics = Metrics(window, periods, riskfree, flows)
+        return metrics.extend((d, v, self.cost[d]) for d, v in Stock._sorted_items(self.value))
+
+    def export(self, output, format=ExportFormat.CSV, period=None):
+        # The data of every stock as one wide table with a symbol column, see StockWriter
+        writer = StockWriter(output, format, symbols=True, period=period)
+        for symbol, stock in self.stocks.items():
+            writer.write(stock, symbol)
+
+    def output(self, output, period=None):
+        # With period, each series as of the last day of each period
+        csvwriter = csv.writer(output)
+        series = (self.value, self.cost, self.gain, self.gainp)
+        if period is not None:
+            dates = Stock._as_series(self.value).resample(period).dates()
+            series = [DateSeries((d, v) for d, v in zip(dates, Stock._as_series(s).get_latest_many(dates))
+                                 if v is not None) for s in series]
+        for title, series in zip(("Value", "Cost", "Gain", "Gain (%)"), series):
+            print(file=output)
+            print("---- {} ----".format(title), file=output)
+            csvwriter.writerow(["Date", title])
+            csvwriter.writerows(Stock._sorted_items(series))
+
+
+class Backtest:
+    # Target weight portfolio over the stocks of a StockSim. Events on a priority queue over the trading calendar
+    # of all histories drive it, in this order on a day: dividends (reinvested, or paid out to cash), a
+    # contribution at the start of each period, a rebalance to the weights (on the first day, then at the start
+    # of each period if periodic), and the close, which values the portfolio and, with a threshold, rebalances
+    # when a weight drifted further than it. Trades are at the latest close and come out as one net cash
+    # transaction per stock and day, so the stocks can be calculated like any others, see simulation().
+    # Weights summing to less than 1 keep the rest in cash, contributions in between rebalances are invested by
+    # weight.
+    Result = namedtuple("Result", "dates, value, cash, transactions, rebalances")
+    Result.__qualname__ = "Backtest.Result"
+    # Event kinds, in their order on one day
+    DIVIDEND, CONTRIBUTION, REBALANCE, CLOSE = range(4)
+
+    def __init__(self, sim, weights, period=Period.MONTH, periodic=True, threshold=None, initial=0, contribution=0,
+                 reinvest=True):
+        super(Backtest, self).__init__()
+        self.sim = sim
+        self.weights = list(weights)
+        # One weight per stock, the trades zip them
+        if len(self.weights) != len(sim.stocks):
+            raise ValueError("{} weights for {} stocks".format(len(self.weights), len(sim.stocks)))
+        if any(w < 0 for w in self.weights):
+            raise ValueError("Negative weight: {}".format(min(self.weights)))
+        self.period = period
+        self.periodic = periodic
+        self.threshold = threshold
+        self.initial = initial
+        self.contribution = contribution
+        self.reinvest = reinvest
+        self.calendar = TradingCalendar.of(sorted(set().union(*(s.history.dates() for s in sim.stocks))))
+
+    def run(self, start=None, end=None):
+        # Returns a Result: the calendar days from start to end (default: all), the value (cash included) and
+        # cash at each close, a cash TransactionHistory per stock and the rebalance days
+        calendar = self.calendar
+        dates = calendar.dates[calendar.before(start) if start else 0:calendar.until(end) if end else len(calendar)]
+        stocks = self.sim.stocks
+        # Closes of every stock as of each day in one batched lookup per stock, then by day
+        days = to_days(dates) if np is not None and dates else None
+        prices = list(zip(*(Backtest._closes(stock.history, dates, days) for stock in stocks)))
+        self._holdings = [0.0] * len(stocks)
+        self._cash = self.initial
+        self._trades = [{} for _ in stocks]
+        value, cash, rebalances = [], [], []
+
+        queue = []
+        sequence = count()
+
+        def push(d, kind, data=None):
+            heappush(queue, (d, kind, next(sequence), data))
+
+        starts = [e + 1 for e in period_ends(dates, self.period)[:-1]] if dates else []
+        for t in starts:
+            push(dates[t], Backtest.CONTRIBUTION)
+            if self.periodic:
+                push(dates[t], Backtest.REBALANCE)
+        if dates:
+            push(dates[0], Backtest.REBALANCE)
+            push(dates[0], Backtest.CLOSE)
+        for i, stock in enumerate(stocks):
+            dividend = stock.history.dividend
+            if dividend is not None and dates:
+                index = dividend.dates()
+                for d in index[bisect_left(index, dates[0]):bisect_right(index, dates[-1])]:
+                    push(d, Backtest.DIVIDEND, i)
+
+        first = calendar.before(dates[0]) if dates else 0
+        while queue:
+            d, kind, _, data = heappop(queue)
+            # Position of the day (or the trading day before it) in dates
+            t = calendar.until(d) - first - 1
+            if kind == Backtest.DIVIDEND:
+                self._dividend(data, stocks[data].history.dividend, d, prices[t][data])
+            elif kind == Backtest.CONTRIBUTION:
+                self._cash += self.contribution
+                if not self.periodic:
+                    self._invest(self.contribution, prices[t], d)
+            elif kind == Backtest.REBALANCE:
+                self._rebalance(prices[t], d)
+                rebalances.append(d)
+            elif kind == Backtest.CLOSE:
+                total = self._value(prices[t])
+                if self.threshold is not None and total > 0 and self._drifted(prices[t], total):
+                    self._rebalance(prices[t], d)
+                    rebalances.append(d)
+                    total = self._value(prices[t])
+                value.append(total)
+                cash.append(self._cash)
+                if t + 1 < len(dates):
+                    push(dates[t + 1], Backtest.CLOSE)
+
+        transactions = []
+        for trades in self._trades:
+            history = TransactionHistory()
+            history.update(trades)
+            transactions.append(history)
+        return Backtest.Result(dates, value, cash, transactions, rebalances)
+
+    def simulation(self, result):
+        # A StockSim of the stocks traded in result, with their histories and the generated transactions
+        sim = StockSim()
+        sim.stocks = []
+        for stock, transactions in zip(self.sim.stocks, result.transactions):
+            if transactions:
+                traded = Stock()
+                traded.history = stock.history
+                traded.transactions = transactions
+                traded.reinvest = self.reinvest
+                sim.stocks.append(traded)
+        return sim
+
+    @staticmethod
+    def _closes(history, dates, days=None):
+        # Close as of each of the sorted dates (their int64 days with numpy), None before the first
+        if days is not None:
+            columns = history.columns()
+            i = np.searchsorted(columns.date.astype(np.int64), days, side="right") - 1
+            closes = np.append(columns.close, np.nan)[i].tolist()
+            return [None if c != c else c for c in closes]
+        return [None if row is None else row.close for row in history.get_latest_many(dates)]
+
+    def _trade(self, i, shares, price, d):
+        self._holdings[i] += shares
+        self._cash -= shares * price
+        self._trades[i][d] = self._trades[i].get(d, 0) + shares * price
+
+    def _value(self, prices):
+        return self._cash + sum(h * p for h, p in zip(self._holdings, prices) if h)
+
+    def _dividend(self, i, dividend, d, price):
+        # Like Stock._replay_shares, or the cash paid out without reinvestment
+        h = self._holdings[i]
+        if not h:
+            return
+        amount = dividend[d]
+        if dividend.type == TransactionType.Shares:
+            shares = h * amount
+            cash = shares * price
+        else:
+            shares = h * amount / price
+            cash = h * amount
+        if self.reinvest:
+            self._holdings[i] += shares
+        else:
+            self._cash += cash
+
+    def _invest(self, amount, prices, d):
+        for i, (w, p) in enumerate(zip(self.weights, prices)):
+            if w and p:
+                self._trade(i, w * amount / p, p, d)
+
+    def _rebalance(self, prices, d):
+        total = self._value(prices)
+        for i, (w, h, p) in enumerate(zip(self.weights, self._holdings, prices)):
+            if p:
+                shares = w * total / p - h
+                if shares:
+                    self._trade(i, shares, p, d)
+
+    def _drifted(self, prices, total):
+        threshold = self.threshold
+        return any(abs(h * p / total - w) > threshold for w, h, p in zip(self.weights, self._holdings, prices) if p)
+
+
+class StockServer:
+    # Keeps the calculated stocks of a manifest and their portfolio in memory and answers queries sent as
+    # newline-delimited JSON over a Unix socket or localhost TCP. A line is one request object or a list of them
+    # (a batch), answered by one response line. Requests name a query and its arguments, dates are YYYY-MM-DD:
+    #   {"query": "value", "symbol": "AAA", "date": "2016-12-30"}  (also shares, cost, gain, gainp and data)
+    #   {"query": "snapshot", "dates": [...], "symbols": [...]}   (symbols optional, see Portfolio.snapshot)
+    #   {"query": "portfolio", "date": "2016-12-30"}
+    #   {"query": "append", "symbol": "AAA", "history": {date: [open, high, low, close, volume]},
+    #    "dividend": {date: amount}, "transactions": {date: amount}}
+    #   {"query": "symbols"}
+    # Responses are {"result": ...} or {"error": message}.
+    def __init__(self):
+        super(StockServer, self).__init__()
+        self.stocks = OrderedDict()
+        self.portfolio = Portfolio()
+        self._parse = DateParser()
+        self._changed = False
+
+    def load(self, entries, processes=None, reinvest=True, cache=None):
+        # Loads and calculates the stocks of manifest entries, keeping their inputs for later appends
+        stocks = load_entries(entries, processes=processes, cache=cache)
+        for stock in stocks.values():
+            stock.reinvest = reinvest
+        task = functools.partial(calc_item, profile=bool(PROFILE_CALLBACKS), memory=tracemalloc.is_tracing())
+        results = run_pool(task, list(stocks.items()), processes)
+        report_profiles(results)
+        for (symbol, stock), result in zip(stocks.items(), results):
+            stock.shares, stock.value, stock.cost, stock.gain, stock.gainp, stock.data = result[1:7]
+            self.stocks[symbol] = stock
+            self.portfolio.add(symbol, stock)
+        self.portfolio.calc()
+
+    def respond(self, line):
+        # Response line of a request line
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {"error": "Invalid JSON: {}".format(e)}
+        else:
+            if isinstance(request, list):
+                response = [self.handle(r) for r in request]
+            else:
+                response = self.handle(request)
+        return (json.dumps(response, default=str) + "\n").encode()
+
+    def handle(self, request):
+        try:
+            query = getattr(self, "query_" + str(request.get("query")), None)
+            if query is None:
+                return {"error": "Unknown query: {}".format(request.get("query"))}
+            return {"result": query(request)}
+        except Exception as e:
+            return {"error": "{}: {}".format(type(e).__name__, e)}
+
+    def _stock(self, request):
+        return self.stocks[request["symbol"]]
+
+    def _date(self, request):
+        return self._parse[request["date"]]
+
+    def query_symbols(self, request):
+        return list(self.stocks)
+
+    def query_shares(self, request):
+        return self._stock(request).get_shares(self._date(request))
+
+    def query_value(self, request):
+        return self._stock(request).get_value(self._date(request))
+
+    def query_cost(self, request):
+        return self._stock(request).get_cost(self._date(request))
+
+    def query_gain(self, request):
+        return self._stock(request).get_gain(self._date(request))
+
+    def query_gainp(self, request):
+        return self._stock(request).get_gainp(self._date(request))
+
+    def query_data(self, request):
+        return self._stock(request)._calc_data(self._date(request))._asdict()
+
+    def query_snapshot(self, request):
+        snapshot = self.portfolio.snapshot([self._parse[d] for d in request["dates"]], request.get("symbols"))
+        return snapshot._asdict()
+
+    def query_portfolio(self, request):
+        if self._changed:
+            self.portfolio.calc()
+            self._changed = False
+        d = self._date(request)
+        return {name: Stock._get_latest(getattr(self.portfolio, name), d)
+                for name in ("value", "cost", "gain", "gainp")}
+
+    def query_append(self, request):
+        # Updates the stock in place from the first date the new rows affect, the portfolio on its next query
+        symbol = request["symbol"]
+        stock = self.stocks[symbol]
+        history = {self._parse[d]: StockHistory.HistoryData(*row) for d, row in request.get("history", {}).items()}
+        dividend = {self._parse[d]: v for d, v in request.get("dividend", {}).items()}
+        transactions = {self._parse[d]: v for d, v in request.get("transactions", {}).items()}
+        stock.append(history, dividend, transactions)
+        self.portfolio.add(symbol, stock)
+        self._changed = True
+        return len(history) + len(dividend) + len(transactions)
+
+    async def serve(self, path=None, host="127.0.0.1", port=8765):
+        # Serves until cancelled, on the Unix socket path if given, else on host and port
+        if path is not None:
+            server = await asyncio.start_unix_server(self._client, path)
+        else:
+            server = await asyncio.start_server(self._client, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    writer.write(self.respond(line))
+                    await writer.drain()
+        finally:
+            writer.close()
+
+
+def query_server(requests, path=None, host="127.0.0.1", port=8765):
+    # Sends requests (a list, sent as one batch) to a StockServer and returns its responses
+    if path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(path)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile("rwb") as file:
+        file.write((json.dumps(requests) + "\n").encode())
+        file.flush()
+        return json.loads(file.readline())
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="TODO")
@@ -431,7 +3193,28 @@ def parse_args():
     parser.add_argument('-j', '--json', action="store_true",
                         help="History data is stored in JSON.")
     parser.add_argument('-o', '--output')
+    parser.add_argument('-c', '--cache', help="Directory for a binary cache of the parsed input files.")
+    parser.add_argument('-r', '--results', metavar="DIRECTORY",
+                        help="Directory for a cache of the calculated series, reused while their inputs are unchanged. "
+                             "Its files are unpickled, so it must only be writable by trusted users.")
+    parser.add_argument('-f', '--format', choices=["sections", "csv", "ndjson", "binary"], default="sections",
+                        help="Output format: a CSV section per series (default), one wide CSV table, "
+                             "newline-delimited JSON or binary columns.")
+    parser.add_argument('--period', choices=["day", "week", "month", "year"], default="day",
+                        help="Only output the last day of each week, month or year (default: every day).")
+    parser.add_argument('--profile', nargs='?', const='-', metavar="FILE",
+                        help="Write a JSON profile of the stages to FILE (default: stderr).")
+    parser.add_argument('--currency', help="Currency of the history and transactions, converted to --base.")
+    parser.add_argument('--base', help="Base currency to value the stock in.")
+    parser.add_argument('--fx', metavar="FILE",
+                        help="History of the --currency/--base exchange rate, the close is the rate.")
+    parser.add_argument('-m', '--metrics', metavar="FILE",
+                        help="Write the return, drawdown, volatility and Sharpe ratio of the stock to FILE.")
+    parser.add_argument('--window', type=int, default=21, help="Days of the rolling volatility (default: 21)")
+    parser.add_argument('--riskfree', type=float, default=0.0, help="Annual risk-free rate (default: 0)")
     args = parser.parse_args()
+    if (args.fx or args.currency or args.base) and not (args.fx and args.currency and args.base):
+        parser.error("--fx, --currency and --base must be given together")
     return args
 
 
@@ -444,16 +3227,47 @@ def main():
     else:
         mode = DataMode.CSV
 
-    stock = Stock()
-    stock.load_files(args.history, args.transactions, args.dividend, mode)
-    stock.reinvest = True
-    stock.calc()
+    with Profiler() if args.profile else contextlib.nullcontext() as profiler, \
+            profile_symbol(history_symbol(args.history, mode) if args.profile else None):
+        stock = Stock()
+        stock.load_files(args.history, args.transactions, args.dividend, mode, args.cache)
+        stock.reinvest = True
+        if args.fx:
+            stock.currency = args.currency
+            stock.base = args.base
+            stock.fx = FxRates()
+            with open(args.fx, newline='') as file:
+                stock.fx.load(args.currency, args.base, file, mode)
+        if args.results:
+            stock.result_cache = ResultCache(args.results)
+        stock.calc()
+        if args.results:
+            print("Result cache: {} hits, {} misses".format(*stock.result_cache.totals()), file=sys.stderr)
+
+        period = None if args.period == "day" else Period[args.period.upper()]
+        if args.format == "binary":
+            if not isinstance(args.output, str):
+                sys.stdout.flush()
+            with open(args.output, 'wb') if isinstance(args.output, str) else \
+                    contextlib.nullcontext(sys.stdout.buffer) as out:
+                stock.export(out, ExportFormat.BINARY, period)
+        else:
+            with open(args.output, 'w', newline='') if isinstance(args.output, str) else sys.stdout as out:
+                if args.format == "sections":
+                    stock.output(out, period)
+                else:
+                    stock.export(out, ExportFormat[args.format.upper()], period)
+
+        if args.metrics:
+            with open(args.metrics, 'w', newline='') as out:
+                stock.metrics(args.window, riskfree=args.riskfree).output(out)
 
-    with open(args.output, 'w', newline='') if isinstance(args.output, str) else sys.stdout as out:
-        stock.output(out)
+    if args.profile:
+        with open(args.profile, 'w') if args.profile != '-' else contextlib.nullcontext(sys.stderr) as out:
+            profiler.write(out)
 
 
 if __name__ == "__main__":
     # execute only if run as a script
-    print("Welcome to StockSim!")
+    print("Welcome to StockSim!", file=sys.stderr)
     main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Simon Shink
+
+# This file is part of StockSim.
+#
+# StockSim is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# StockSim is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with StockSim.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import math
+import random
+import tempfile
+import threading
+import unittest
+from stocksim import *
+
+START = date(2015, 1, 1)
+
+
+def history_text(days, seed):
+    # Weekday closes as a random walk
+    rng = random.Random(seed)
+    close = 20.0
+    rows = []
+    for i in range(days):
+        d = START + timedelta(i)
+        if d.weekday() < 5:
+            close = round(max(0.5, close * (1 + rng.gauss(0, 0.02))), 2)
+            rows.append("{},{},{},{},{},{}\n".format(d, close, close, close, close, rng.randint(1, 1000)))
+    return "Date,Open,High,Low,Close,Volume\n" + "".join(rows)
+
+
+def random_stock(seed, transaction_type=TransactionType.Cash, reinvest=True):
+    # A stock with transactions and dividends on random days, some of them on the same day (and on days the
+    # position is sold out)
+    rng = random.Random(seed)
+    days = rng.randint(20, 200)
+    stock = Stock()
+    stock.history.load(history_text(days, seed))
+    stock.history.init_dividend()
+    stock.transactions.type = transaction_type
+    dates = sorted(rng.sample(range(days), rng.randint(1, min(days, 12))))
+    shares = 0
+    transactions = {}
+    for i in dates:
+        amount = rng.choice([rng.randint(1, 20), -shares])
+        shares += amount
+        d = START + timedelta(i)
+        if d in stock.history:
+            transactions[d] = amount if transaction_type == TransactionType.Shares else \
+                round(amount * stock.history[d].close, 2)
+    if not transactions:
+        d = stock.history.dates()[0]
+        transactions[d] = 10
+    stock.transactions.update(transactions)
+    dividend = set(rng.sample(range(days), rng.randint(0, 6))) | set(d.toordinal() - START.toordinal()
+                                                                      for d in rng.sample(sorted(transactions), 1))
+    stock.history.dividend.update((START + timedelta(i), round(rng.uniform(0.01, 0.5), 3)) for i in dividend)
+    stock.reinvest = reinvest
+    return stock
+
+
+def calculated(stock, columnar=False):
+    stock.columnar = columnar
+    stock.calc()
+    return stock
+
+
+class JsonStreamTest(unittest.TestCase):
+    TEXT = json.dumps([True, 197450537853, None, -419554.1814474646, "a\\\"b\\\\\u00e9\n\"",
+                       {"x\"": [1, {"y": "]}"}], "z": -1e-05}, [], "last"])
+
+    def test_skip(self):
+        # Every other element skipped, with numbers and strings split across chunks
+        expected = json.loads(JsonStreamTest.TEXT)
+        for size in (1, 2, 3, 7, 1 << 16):
+            stream = JsonStream(io.StringIO(JsonStreamTest.TEXT), size)
+            values = []
+            for i in stream.elements():
+                if i % 2:
+                    values.append(stream.value())
+                else:
+                    stream.skip()
+            self.assertEqual(expected[1::2], values, size)
+
+    def test_quotemedia_symbols(self):
+        text = json.dumps({"results": {"dividends": [
+            {"symbolstring": "AAA", "company": {"name": "A"}, "dividend": [{"date": "2016-01-04", "amount": 0.5}]},
+            {"symbol": "BBB", "dividend": [{"date": "2016-01-05", "amount": 0.25}]}]}})
+        records = list(iter_quotemedia(text, "dividends", "dividend"))
+        self.assertEqual([{"symbolstring": "AAA"}, {"symbol": "BBB"}], [info for entry, info, record in records])
+        self.assertEqual(["AAA", "BBB"], list(DividendHistory.load_symbols(text)))
+
+
+@unittest.skipIf(np is None, "columnar mode needs numpy")
+class ColumnarTest(unittest.TestCase):
+    def assertSameSeries(self, expected, actual):
+        for name in ("shares", "value", "cost", "gain", "gainp"):
+            e = Stock._as_series(getattr(expected, name))
+            a = Stock._as_series(getattr(actual, name))
+            self.assertEqual(e.dates(), a.dates(), name)
+            for d in e.dates():
+                self.assertAlmostEqual(e[d], a[d], places=6, msg="{} {}".format(name, d))
+
+    def test_dividend_on_first_transaction(self):
+        for columnar in (False, True):
+            stock = Stock()
+            stock.history.load(history_text(30, 1))
+            stock.history.init_dividend()
+            d = stock.history.dates()[2]
+            stock.history.dividend[d] = 0.5
+            stock.transactions[d] = 100
+            stock.reinvest = True
+            calculated(stock, columnar)
+            if columnar:
+                self.assertSameSeries(expected, stock)
+            expected = stock
+
+    def test_dividend_on_sell_out(self):
+        stock = Stock()
+        stock.history.load(history_text(30, 2))
+        stock.history.init_dividend()
+        days = stock.history.dates()
+        stock.transactions.type = TransactionType.Shares
+        stock.transactions.update({days[1]: 10, days[5]: -10, days[9]: 5})
+        stock.history.dividend.update({days[5]: 0.2, days[9]: 0.1})
+        stock.reinvest = True
+        expected = calculated(stock)
+        stock = Stock()
+        stock.history, stock.transactions, stock.reinvest = expected.history, expected.transactions, True
+        self.assertSameSeries(expected, calculated(stock, True))
+
+    def test_random(self):
+        for seed in range(300):
+            for transaction_type in (TransactionType.Cash, TransactionType.Shares):
+                with self.subTest(seed=seed, type=transaction_type.name):
+                    expected = calculated(random_stock(seed, transaction_type))
+                    self.assertSameSeries(expected, calculated(random_stock(seed, transaction_type), True))
+
+
+class AppendTest(unittest.TestCase):
+    def test_random(self):
+        # Appending the later transactions and dividends gives the same results as calculating them all at once
+        for seed in range(300):
+            for transaction_type in (TransactionType.Cash, TransactionType.Shares):
+                with self.subTest(seed=seed, type=transaction_type.name):
+                    expected = calculated(random_stock(seed, transaction_type))
+                    stock = random_stock(seed, transaction_type)
+                    rng = random.Random(seed)
+                    since = rng.choice(stock.history.dates())
+                    transactions = {d: stock.transactions.pop(d) for d in list(stock.transactions) if d >= since}
+                    dividend = {d: stock.history.dividend.pop(d) for d in list(stock.history.dividend) if d >= since}
+                    if not stock.transactions:
+                        continue
+                    calculated(stock).append(dividend=dividend, transactions=transactions)
+                    self.assertEqual(list(expected.data), list(stock.data))
+                    for d in expected.data:
+                        for name, e, a in zip(Stock.StockData._fields, expected.data[d], stock.data[d]):
+                            if e is None or a is None:
+                                self.assertEqual(e, a, "{} {}".format(name, d))
+                            else:
+                                self.assertAlmostEqual(e, a, places=6, msg="{} {}".format(name, d))
+
+
+@unittest.skipIf(np is None, "scenario batches need numpy")
+class ScenarioBatchTest(unittest.TestCase):
+    def test_rows_match_calc(self):
+        for seed in range(20):
+            with self.subTest(seed=seed):
+                history = random_stock(seed).history
+                rng = random.Random(seed)
+                scenarios = []
+                for i in range(rng.randint(1, 12)):
+                    transactions = random_stock(seed * 100 + i, rng.choice(list(TransactionType))).transactions
+                    for d in [d for d in transactions if d not in history]:
+                        del transactions[d]
+                    if not transactions:
+                        transactions[history.dates()[-1]] = 3
+                    scenarios.append(ScenarioBatch.Scenario(i, transactions, rng.random() < 0.5))
+                ScenarioBatch.BLOCK = rng.choice([1, 5, 256])
+                try:
+                    result = ScenarioBatch(history).run(scenarios, series=True)
+                finally:
+                    ScenarioBatch.BLOCK = 256
+                for i, scenario in enumerate(scenarios):
+                    stock = Stock()
+                    stock.history, stock.transactions, stock.reinvest = history, scenario.transactions, \
+                        scenario.reinvest
+                    stock.calc()
+                    for j, d in enumerate(history.dates()):
+                        expected = stock._calc_data(d)
+                        for name, matrix in zip(expected._fields, result[3:]):
+                            if getattr(expected, name) is None:
+                                self.assertTrue(np.isnan(matrix[i, j]), "{} {} {}".format(i, name, d))
+                            else:
+                                self.assertAlmostEqual(getattr(expected, name), matrix[i, j], places=6,
+                                                       msg="{} {} {}".format(i, name, d))
+                    for name in ScenarioBatch.SUMMARY[:5]:
+                        self.assertTrue(np.array_equal(result.summary[name][i], getattr(result, name)[i, -1],
+                                                       equal_nan=True), name)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_moments(self):
+        moments = Moments()
+        for x in (1.0, 2.0, 3.0, 4.0, 5.0):
+            moments.add(x)
+        self.assertAlmostEqual(3.0, moments.mean)
+        self.assertAlmostEqual(2.5, moments.variance())
+        moments.remove(1.0)
+        self.assertAlmostEqual(3.5, moments.mean)
+        self.assertAlmostEqual(5 / 3, moments.variance())
+        for x in (2.0, 3.0, 4.0):
+            moments.remove(x)
+        self.assertIsNone(moments.variance())
+
+    def test_small_series(self):
+        # Returns 10%, -10%, 0% (50 paid in on day 3) and 10%
+        days = [START + timedelta(i) for i in range(5)]
+        metrics = Metrics(window=2, periods=4, flows=[(days[0], -100), (days[3], -50)])
+        metrics.extend(zip(days, (100, 110, 99, 149, 163.9), (100, 100, 100, 150, 150)))
+        summary = metrics.summary()
+        self.assertEqual((days[0], days[-1]), (summary.start, summary.end))
+        self.assertAlmostEqual(1.1 * 0.9 * 1.0 * 1.1 - 1, summary.twr)
+        self.assertAlmostEqual(0.99 / 1.1 - 1, summary.max_drawdown)
+        # Mean 0.025, sample variance 0.0275 / 3
+        self.assertAlmostEqual(math.sqrt(0.0275 / 3 * 4), summary.volatility)
+        self.assertAlmostEqual(0.025 / math.sqrt(0.0275 / 3) * 2, summary.sharpe)
+        self.assertEqual(days[2:], metrics.volatility.dates())
+        for d, variance in zip(days[2:], (0.02, 0.005, 0.005)):
+            self.assertAlmostEqual(math.sqrt(variance * 4), metrics.volatility[d])
+        # XIRR of the flows and the last value
+        flows = metrics.flows + [(days[-1], 163.9)]
+        self.assertAlmostEqual(0, sum(a * (1 + summary.xirr) ** -((d - days[0]).days / 365.0) for d, a in flows))
+
+    def test_xirr(self):
+        self.assertAlmostEqual(0.1, Metrics.xirr([(date(2015, 1, 1), -100), (date(2016, 1, 1), 110)]))
+        flows = [(date(2015, 1, 1), -100), (date(2015, 3, 17), -40), (date(2015, 9, 2), 25), (date(2016, 5, 30), 150)]
+        rate = Metrics.xirr(flows)
+        self.assertAlmostEqual(0, sum(a * (1 + rate) ** -((d - flows[0][0]).days / 365.0) for d, a in flows))
+        self.assertIsNone(Metrics.xirr([(date(2015, 1, 1), 0)]))
+
+    def test_constant_rate(self):
+        # Valuing a stock in another currency at a constant rate scales every amount, so no return changes
+        for seed in range(10):
+            with self.subTest(seed=seed):
+                local = calculated(random_stock(seed)).metrics().summary()
+                stock = random_stock(seed)
+                rates = StockHistory()
+                rates.update((d, StockHistory.HistoryData(2.0, 2.0, 2.0, 2.0, 0)) for d in stock.history.dates())
+                stock.fx = FxRates()
+                stock.fx.add("USD", "EUR", rates)
+                stock.currency, stock.base = "USD", "EUR"
+                converted = calculated(stock).metrics().summary()
+                self.assertEqual(local.xirr is None, converted.xirr is None)
+                for name in ("twr", "xirr", "max_drawdown", "volatility", "sharpe"):
+                    if getattr(local, name) is not None:
+                        self.assertAlmostEqual(getattr(local, name), getattr(converted, name), places=6, msg=name)
+
+
+class BacktestTest(unittest.TestCase):
+    @staticmethod
+    def sim(seeds):
+        sim = StockSim()
+        sim.stocks = []
+        for seed in seeds:
+            stock = Stock()
+            stock.history = random_stock(seed).history
+            sim.stocks.append(stock)
+        return sim
+
+    def test_weights(self):
+        sim = BacktestTest.sim((1, 2))
+        with self.assertRaises(ValueError):
+            Backtest(sim, [1.0])
+        with self.assertRaises(ValueError):
+            Backtest(sim, [0.5, 0.3, 0.2])
+        with self.assertRaises(ValueError):
+            Backtest(sim, [1.2, -0.2])
+
+    def test_simulation_matches_run(self):
+        # The generated transactions, calculated like any others, hold the invested part of the value
+        for seed in range(5):
+            for periodic, threshold, reinvest in ((True, None, True), (False, 0.05, False)):
+                with self.subTest(seed=seed, periodic=periodic):
+                    seeds = (seed * 3 + 1, seed * 3 + 2, seed * 3 + 3)
+                    backtest = Backtest(BacktestTest.sim(seeds), [0.5, 0.3, 0.1], Period.WEEK, periodic, threshold,
+                                        initial=10000, contribution=500, reinvest=reinvest)
+                    result = backtest.run()
+                    portfolio = backtest.simulation(result).calc()
+                    for d, value, cash in zip(result.dates, result.value, result.cash):
+                        self.assertAlmostEqual(value - cash, portfolio.value.get_latest(d) or 0, places=6,
+                                               msg=str(d))
+
+
+class PriceStoreTest(unittest.TestCase):
+    @staticmethod
+    def sim():
+        # The last stock trades on the history of the first, so they share a segment
+        sim = StockSim()
+        sim.stocks = [random_stock(seed) for seed in range(4)]
+        sim.stocks[-1].history = sim.stocks[0].history
+        return sim
+
+    def test_shared_calc(self):
+        expected = PriceStoreTest.sim()
+        expected.calc()
+        sim = PriceStoreTest.sim()
+        with PriceStore() as store:
+            sim.share(store)
+            self.assertEqual(3, len(store.segments))
+            self.assertTrue(all(isinstance(stock.history, SharedHistory) for stock in sim.stocks))
+            sim.calc(processes=2)
+        self.assertEqual(dict(expected.portfolio.value), dict(sim.portfolio.value))
+        self.assertEqual(dict(expected.portfolio.cost), dict(sim.portfolio.cost))
+        for e, a in zip(expected.stocks, sim.stocks):
+            self.assertEqual(e.data, a.data)
+
+    def test_release(self):
+        store = PriceStore()
+        history = random_stock(1).history
+        shared = store.put(history)
+        self.assertEqual(dict(history), dict(shared))
+        store.acquire(shared)
+        store.release(shared)
+        self.assertIn(shared.path, store.segments)
+        SharedSegment(shared.path).close()
+        store.release(shared)
+        self.assertNotIn(shared.path, store.segments)
+        with self.assertRaises(FileNotFoundError):
+            SharedSegment(shared.path)
+
+
+class ProfileTest(unittest.TestCase):
+    def test_symbol_per_thread(self):
+        # Stages of threads loading at the same time are reported for the symbol of their own thread
+        barrier = threading.Barrier(4)
+
+        def load(symbol):
+            with profile_symbol(symbol):
+                for seed in range(5):
+                    barrier.wait()
+                    StockHistory().load(history_text(50, seed))
+                barrier.wait()
+
+        with Profiler(memory=False) as profiler:
+            threads = [threading.Thread(target=load, args=(symbol,)) for symbol in "ABCD"]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sorted("ABCD" * 5), sorted(record.symbol for record in profiler.records))
+
+
+class ManifestTest(unittest.TestCase):
+    def test_duplicate_symbol(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "manifest.csv")
+            with open(path, "w") as file:
+                file.write("symbol,history,transactions\nAAA,a.txt,a.csv\nBBB,b.txt,b.csv\nAAA,c.txt,c.csv\n")
+            with self.assertRaises(ValueError):
+                read_manifest(path)
+        entries = [ManifestEntry("AAA", "a.txt", "a.csv", None, DataMode.CSV)] * 2
+        with self.assertRaises(ValueError):
+            load_entries(entries)
+        with self.assertRaises(ValueError):
+            Portfolio().calc_entries(entries)
+
+
+class HistoryCacheTest(unittest.TestCase):
+    def test_wrong_size_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as folder:
+            history, transactions = os.path.join(folder, "history.txt"), os.path.join(folder, "transactions.csv")
+            with open(history, "w") as file:
+                file.write(history_text(60, 1))
+            with open(transactions, "w") as file:
+                file.write("Date,Amount\n2015-01-05,100\n2015-02-02,50\n")
+            expected = Stock()
+            expected.load_files(history, transactions)
+            cache = HistoryCache(os.path.join(folder, "cache"))
+            cache.load(history, DataMode.CSV, StockHistory())
+            cache.load(transactions, DataMode.CSV, TransactionHistory())
+            for change in (-8, 16):
+                for source, series, loaded in ((history, StockHistory, expected.history),
+                                               (transactions, TransactionHistory, expected.transactions)):
+                    path = cache.path(source, DataMode.CSV)
+                    size = os.path.getsize(path)
+                    with open(path, "r+b") as file:
+                        file.truncate(size + change)
+                    self.assertIsNone(cache.open(source, DataMode.CSV, series()))
+                    if series is StockHistory:
+                        with self.assertRaises(ValueError):
+                            open_mapped_history(path)
+                    self.assertEqual(dict(loaded.items()), dict(cache.load(source, DataMode.CSV, series()).items()))
+                    self.assertEqual(size, os.path.getsize(path))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_source_fingerprint(self):
+        # Inputs loaded through the history cache are keyed by their source files, and still by their content once
+        # they change
+        with tempfile.TemporaryDirectory() as folder:
+            history, transactions = os.path.join(folder, "history.txt"), os.path.join(folder, "transactions.csv")
+            with open(history, "w") as file:
+                file.write(history_text(60, 1))
+            with open(transactions, "w") as file:
+                file.write("Date,Amount\n2015-01-05,100\n2015-02-02,50\n")
+            results = ResultCache(os.path.join(folder, "results"))
+            for expected in ((0, 6), (6, 6)):
+                stock = Stock()
+                stock.load_files(history, transactions, cache=os.path.join(folder, "cache"))
+                self.assertIsNotNone(stock.transactions._fingerprint)
+                stock.result_cache = results
+                stock.calc()
+                self.assertEqual(expected, results.totals())
+            plain = Stock()
+            plain.load_files(history, transactions)
+            plain.calc()
+            self.assertEqual(plain.data, stock.data)
+            source = stock.transactions.fingerprint()
+            stock.transactions[date(2015, 3, 2)] = 10
+            self.assertNotEqual(source, stock.transactions.fingerprint())
+            stock.calc()
+            self.assertEqual((6, 12), results.totals())
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_matches_point_queries_after_append(self):
+        portfolio = Portfolio()
+        stocks = [calculated(random_stock(seed)) for seed in range(5)]
+        for i, stock in enumerate(stocks):
+            portfolio.add(i, stock)
+        dates = [START + timedelta(i) for i in range(-5, 220, 7)]
+        portfolio.snapshot(dates)
+        last = stocks[0].history.dates()[-1]
+        stocks[0].append(history={last: StockHistory.HistoryData(1.0, 1.0, 1.0, 1.0, 1)})
+        snapshot = portfolio.snapshot(dates)
+        for i, stock in enumerate(stocks):
+            for j, d in enumerate(dates):
+                self.assertEqual(stock.get_value(d), snapshot.value[i][j])
+                self.assertEqual(stock.get_cost(d), snapshot.cost[i][j])
+                self.assertEqual(stock.get_gainp(d), snapshot.gainp[i][j])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -143,6 +143,10 @@ ColumnLayout {
                 TabButton {
                     text: qsTr("Value")
                 }
+
+                TabButton {
+                    text: qsTr("Chart")
+                }
             }
 
             StackLayout {
@@ -155,13 +159,15 @@ ColumnLayout {
                     id: historyTab
                     anchors.bottom: parent.bottom
 
-                    ScrollView {
+                    ListView {
+                        id: historyData
                         Layout.fillHeight: true
                         Layout.fillWidth: true
-
-                        TextArea {
-                            id: historyData
-                            text: qsTr("History data")
+                        clip: true
+                        model: historyModel
+                        delegate: Text {
+                            text: date + "  " + number(open, 2) + "  " + number(high, 2) + "  " + number(low, 2) +
+                                  "  " + number(close, 2) + "  " + number(volume, 0)
                         }
                     }
 
@@ -176,15 +182,6 @@ ColumnLayout {
                                 stocksim.open_history()
                             }
                         }
-                        Button {
-                            id: loadHistory
-                            text: qsTr("Load")
-                            onClicked: {
-                                stocksim.load_history(historyData.text)
-                                statusBar.text = "History loaded"
-                                statusBar.update()
-                            }
-                        }
                     }
                 }
 
@@ -205,11 +202,15 @@ ColumnLayout {
                         }
                     }
 
-                    TextArea {
+                    ListView {
                         id: transactionData
-                        text: "Transactions"
                         Layout.fillHeight: true
                         Layout.fillWidth: true
+                        clip: true
+                        model: transactionsModel
+                        delegate: Text {
+                            text: date + "  " + number(value, 2)
+                        }
                     }
 
                     RowLayout {
@@ -220,61 +221,115 @@ ColumnLayout {
                                 stocksim.open_transactions()
                             }
                         }
-                        Button {
-                            id: loadTransactions
-                            text: qsTr("Load")
-                            onClicked: {
-                                stocksim.load_transactions(transactionData.text)
-                                statusBar.text = "Transactions loaded"
-                                statusBar.update()
-                            }
-                        }
                     }
                 }
 
                 ColumnLayout {
                     id: valueTab
 
-                    RowLayout {
-                        ColumnLayout {
-                            Text {
-                                text: qsTr("Shares")
-                            }
-                            TextArea {
-                                id: sharesData
-                                Layout.fillHeight: true
-                                Layout.fillWidth: true
-                            }
-                        }
-                        ColumnLayout {
-                            Text {
-                                text: qsTr("Value")
-                            }
-                            TextArea {
-                                id: valueData
-                                Layout.fillHeight: true
-                                Layout.fillWidth: true
-                            }
+                    Text {
+                        text: qsTr("Date, shares, value, cost, gain, gain (%)")
+                    }
+                    ListView {
+                        id: valueData
+                        Layout.fillHeight: true
+                        Layout.fillWidth: true
+                        clip: true
+                        model: stockData
+                        delegate: Text {
+                            text: date + "  " + number(shares, 4) + "  " + number(value, 2) + "  " + number(cost, 2) +
+                                  "  " + number(gain, 2) + "  " + number(gainp, 4)
                         }
                     }
                     Button {
                         id: calcValue
                         text: "Calculate"
                         onClicked: {
-                            stocksim.calc_stock_shares(0)
-                            stocksim.calc_stock_value(0)
-
-                            sharesData.update()
-                            valueData.update()
-                            statusBar.text = "Value data updated"
+                            stocksim.calc_stock(0)
+                            statusBar.text = "Calculating"
                             statusBar.update()
                         }
                     }
                 }
+
+                ColumnLayout {
+                    id: chartTab
+
+                    Text {
+                        text: qsTr("Value")
+                    }
+                    Canvas {
+                        id: chart
+                        Layout.fillHeight: true
+                        Layout.fillWidth: true
+                        // At most a point per pixel, the model only keeps every step-th row
+                        onWidthChanged: chartData.decimate(Math.max(2, Math.floor(width)))
+                        onPaint: {
+                            var ctx = getContext("2d")
+                            ctx.reset()
+                            var n = chartPoints.count
+                            var low = Infinity
+                            var high = -Infinity
+                            for (var i = 0; i < n; i++) {
+                                var v = chartPoints.itemAt(i).point
+                                if (v !== undefined && v !== null) {
+                                    low = Math.min(low, v)
+                                    high = Math.max(high, v)
+                                }
+                            }
+                            if (n < 2 || low > high)
+                                return
+                            var range = high > low ? high - low : 1
+                            ctx.strokeStyle = "steelblue"
+                            ctx.lineWidth = 1
+                            ctx.beginPath()
+                            var drawing = false
+                            for (i = 0; i < n; i++) {
+                                v = chartPoints.itemAt(i).point
+                                if (v === undefined || v === null) {
+                                    drawing = false
+                                    continue
+                                }
+                                var x = i * (width - 1) / (n - 1)
+                                var y = (height - 1) * (high - v) / range
+                                if (drawing)
+                                    ctx.lineTo(x, y)
+                                else
+                                    ctx.moveTo(x, y)
+                                drawing = true
+                            }
+                            ctx.stroke()
+                        }
+
+                        Repeater {
+                            id: chartPoints
+                            model: chartData
+                            onCountChanged: chart.requestPaint()
+                            delegate: Item {
+                                property var point: value
+                                visible: false
+                                onPointChanged: chart.requestPaint()
+                            }
+                        }
+                    }
+                }
             }
         }
     }
 
+    Connections {
+        target: stocksim
+        onProgress: {
+            statusBar.text = key + ": " + done + " of " + total
+        }
+        onFinished: {
+            statusBar.text = key + " done"
+        }
+        onFailed: {
+            statusBar.text = key + " failed: " + error
+        }
+    }
+
     Text {
         id: statusBar
         text: qsTr("Ready")
@@ -282,11 +337,7 @@ ColumnLayout {
         anchors.bottom: parent.bottom
     }
 
-    function update_history(data){
-        historyData.text = data
-    }
-
-    function update_transactions(data){
-        transactionData.text = data
+    function number(v, decimals){
+        return v === undefined || v === null ? "" : Number(v).toFixed(decimals)
     }
 }